@@ -1,15 +1,27 @@
 import arabic_reshaper
+import bisect
+import codecs
+import copy
+import errno
+import gzip
 import hashlib
+import heapq
+import http.client
 import json
 import math
 import os
 import random
 import re
+import select
+import shutil
 import socket
+import sqlite3
 import sys
 import textwrap
 import threading
 import time
+import unicodedata
+import zlib
 # ==========================================
 DEBUG = True
 if DEBUG:
@@ -20,8 +32,13 @@ else:
     os.environ['KIVY_NO_CONSOLELOG'] = '1'
 # ==========================================
 from PIL import Image, ImageDraw, ImageFont
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from bidi.algorithm import get_display
 from datetime import datetime, timedelta
+from urllib.parse import quote, urlparse
 from kivy.clock import Clock, mainthread
 from kivy.config import Config
 from kivy.core.text import LabelBase
@@ -29,7 +46,6 @@ from kivy.core.window import Window
 from kivy.graphics.context_instructions import PushMatrix, PopMatrix, Rotate
 from kivy.lang import Builder
 from kivy.metrics import dp
-from kivy.network.urlrequest import UrlRequest
 from kivy.properties import StringProperty, NumericProperty, ObjectProperty, ListProperty, BooleanProperty, ColorProperty
 from kivy.storage.jsonstore import JsonStore
 from kivy.uix.camera import Camera
@@ -114,6 +130,11 @@ if not custom_font_loaded:
 reshaper = arabic_reshaper.ArabicReshaper(configuration={'delete_harakat': True, 'support_ligatures': True, 'use_unshaped_instead_of_isolated': True})
 # ==========================================
 DEFAULT_PORT = '5000'
+SYNC_BATCH_SIZE = 50
+SYNC_MAX_IN_FLIGHT = 2
+SYNC_PARK_AFTER = 5
+ENTITY_HISTORY_PAGE = 50
+ENTITY_HISTORY_TTL = 60
 # ==========================================
 KV_BUILDER = '\n<LeftButtonsContainer>:\n    adaptive_width: True\n    spacing: "4dp"\n    padding: "4dp"\n    pos_hint: {"center_y": .5}\n\n<RightButtonsContainer>:\n    adaptive_width: True\n    spacing: "8dp"\n    pos_hint: {"center_y": .5}\n\n<CustomHistoryItem>:\n    orientation: "horizontal"\n    size_hint_y: None\n    height: dp(80)\n    padding: dp(10)\n    spacing: dp(5)\n    radius: [10]\n    elevation: 1\n    ripple_behavior: True\n    md_bg_color: root.bg_color\n    on_release: root.on_tap_action()\n    \n    MDIcon:\n        icon: root.icon\n        theme_text_color: "Custom"\n        text_color: root.icon_color\n        pos_hint: {"center_y": .5}\n        font_size: "32sp"\n        size_hint_x: None\n        width: dp(40)\n        \n    MDBoxLayout:\n        orientation: "vertical"\n        pos_hint: {"center_y": .5}\n        spacing: dp(4)\n        size_hint_x: 0.5\n        \n        MDLabel:\n            text: root.text\n            bold: True\n            font_style: "Subtitle1"\n            font_size: "16sp"\n            theme_text_color: "Primary"\n            shorten: True\n            shorten_from: \'right\'\n            font_name: \'ArabicFont\'\n            markup: True\n            \n        MDLabel:\n            text: root.secondary_text\n            font_style: "Caption"\n            theme_text_color: "Secondary"\n            font_name: \'ArabicFont\'\n            \n    MDLabel:\n        text: root.right_text\n        halign: "right"\n        pos_hint: {"center_y": .5}\n        font_style: "Subtitle2"\n        bold: True\n        theme_text_color: "Custom"\n        text_color: root.icon_color\n        size_hint_x: 0.3\n        font_name: \'ArabicFont\'\n\n    MDIconButton:\n        icon: "pencil"\n        theme_text_color: "Custom"\n        text_color: (0, 0.5, 0.8, 1)\n        pos_hint: {"center_y": .5}\n        on_release: root.on_edit_action()\n\n<ProductRecycleItem>:\n    orientation: \'vertical\'\n    size_hint_y: None\n    height: dp(90)\n    padding: 0\n    spacing: 0\n    \n    MDCard:\n        orientation: \'horizontal\'\n        padding: dp(10)\n        spacing: dp(10)\n        radius: [8]\n        elevation: 1\n        ripple_behavior: True\n        on_release: root.on_tap()\n        md_bg_color: (1, 1, 1, 1)\n        \n        MDIcon:\n            icon: root.icon_name\n            theme_text_color: "Custom"\n            text_color: root.icon_color\n            size_hint_x: None\n            width: dp(40)\n            pos_hint: {\'center_y\': .5}\n            font_size: \'32sp\'\n\n        MDBoxLayout:\n            orientation: \'vertical\'\n            pos_hint: {\'center_y\': .5}\n            spacing: dp(5)\n            \n            MDLabel:\n                text: root.text_name\n                font_style: "Subtitle1"\n                bold: True\n                text_size: self.width, None\n                max_lines: 2\n                halign: \'left\'\n                font_size: \'17sp\'\n                theme_text_color: "Custom"\n                text_color: (0.1, 0.1, 0.1, 1)\n                font_name: \'ArabicFont\'\n            \n            MDBoxLayout:\n                orientation: \'horizontal\'\n                spacing: dp(10)\n                \n                MDLabel:\n                    text: root.text_price\n                    font_style: "H6"\n                    theme_text_color: "Custom"\n                    text_color: root.price_color\n                    bold: True\n                    size_hint_x: 0.6\n                    font_size: \'20sp\'\n                    font_name: \'ArabicFont\'\n                \n                MDLabel:\n                    text: root.text_stock\n                    theme_text_color: "Custom"\n                    text_color: (0.1, 0.1, 0.1, 1)\n                    halign: \'right\'\n                    size_hint_x: 0.4\n                    bold: True\n                    font_size: \'16sp\'\n                    font_name: \'ArabicFont\'\n\n<ProductRecycleView>:\n    viewclass: \'ProductRecycleItem\'\n    RecycleBoxLayout:\n        default_size: None, dp(95)\n        default_size_hint: 1, None\n        size_hint_y: None\n        height: self.minimum_height\n        orientation: \'vertical\'\n        spacing: dp(4)\n        padding: dp(5)\n\n<HistoryRecycleItem>:\n    orientation: "horizontal"\n    size_hint_y: None\n    height: dp(80)\n    padding: dp(10)\n    spacing: dp(5)\n    radius: [10]\n    elevation: 1\n    ripple_behavior: True\n    md_bg_color: root.bg_color\n    on_release: root.on_tap()\n\n    MDIcon:\n        icon: root.icon_name\n        theme_text_color: "Custom"\n        text_color: root.icon_color\n        pos_hint: {"center_y": .5}\n        font_size: "32sp"\n        size_hint_x: None\n        width: dp(40)\n\n    MDBoxLayout:\n        orientation: "vertical"\n        pos_hint: {"center_y": .5}\n        spacing: dp(4)\n        size_hint_x: 1\n\n        MDLabel:\n            text: root.text_primary\n            bold: True\n            font_style: "Subtitle1"\n            font_size: "16sp"\n            theme_text_color: "Primary"\n            text_size: self.width, None\n            halign: \'left\'\n            font_name: \'ArabicFont\'\n            markup: True\n\n        MDLabel:\n            text: root.text_secondary\n            font_style: "Caption"\n            theme_text_color: "Secondary"\n            font_name: \'ArabicFont\'\n\n    MDLabel:\n        text: root.text_amount\n        halign: "right"\n        pos_hint: {"center_y": .5}\n        font_style: "Subtitle2"\n        bold: True\n        theme_text_color: "Custom"\n        text_color: root.icon_color\n        size_hint_x: None\n        width: dp(110)\n        font_name: \'ArabicFont\'\n\n<HistoryRecycleView>:\n    viewclass: \'HistoryRecycleItem\'\n    RecycleBoxLayout:\n        default_size: None, dp(85)\n        default_size_hint: 1, None\n        size_hint_y: None\n        height: self.minimum_height\n        orientation: \'vertical\'\n        spacing: dp(5)\n        padding: dp(5)\n\n<EntityRecycleItem>:\n    orientation: "horizontal"\n    size_hint_y: None\n    height: dp(80)\n    padding: dp(10)\n    spacing: dp(15)\n    ripple_behavior: True\n    md_bg_color: (1, 1, 1, 1)\n    radius: [0]\n    on_release: root.on_tap()\n\n    MDIcon:\n        icon: root.icon_name\n        theme_text_color: "Custom"\n        text_color: root.icon_color\n        pos_hint: {"center_y": .5}\n        font_size: "32sp"\n        size_hint_x: None\n        width: dp(40)\n\n    MDBoxLayout:\n        orientation: "vertical"\n        pos_hint: {"center_y": .5}\n        size_hint_x: 1\n        spacing: dp(4)\n\n        MDLabel:\n            text: root.text_name\n            bold: True\n            font_style: "Subtitle1"\n            font_name: \'ArabicFont\'\n            theme_text_color: "Custom"\n            text_color: (0.1, 0.1, 0.1, 1)\n            shorten: True\n            shorten_from: \'right\'\n            valign: \'center\'\n\n        MDLabel:\n            text: root.text_balance\n            font_style: "Caption"\n            font_name: \'ArabicFont\'\n            markup: True\n            theme_text_color: "Secondary"\n            valign: \'top\'\n\n<EntityRecycleView>:\n    viewclass: \'EntityRecycleItem\'\n    RecycleBoxLayout:\n        default_size: None, dp(80)\n        default_size_hint: 1, None\n        size_hint_y: None\n        height: self.minimum_height\n        orientation: \'vertical\'\n        spacing: dp(2)\n        padding: dp(0)\n\n<MgmtEntityRecycleItem>:\n    orientation: "horizontal"\n    size_hint_y: None\n    height: dp(80)\n    padding: dp(10)\n    spacing: dp(5)\n    ripple_behavior: True\n    md_bg_color: (1, 1, 1, 1)\n    on_release: root.on_pay()\n\n    MDIcon:\n        icon: "account-circle"\n        theme_text_color: "Custom"\n        text_color: (0.5, 0.5, 0.5, 1)\n        pos_hint: {"center_y": .5}\n        font_size: "32sp"\n        size_hint_x: None\n        width: dp(40)\n\n    MDBoxLayout:\n        orientation: "vertical"\n        pos_hint: {"center_y": .5}\n        size_hint_x: 1\n        spacing: dp(2)\n        padding: [dp(10), 0, 0, 0]\n\n        MDLabel:\n            text: root.text_name\n            bold: True\n            font_style: "Subtitle1"\n            font_name: \'ArabicFont\'\n            theme_text_color: "Custom"\n            text_color: (0.1, 0.1, 0.1, 1)\n            shorten: True\n            shorten_from: \'right\'\n            halign: "left"\n\n        MDLabel:\n            text: root.text_balance\n            font_style: "Caption"\n            font_name: \'ArabicFont\'\n            markup: True\n            theme_text_color: "Secondary"\n            halign: "left"\n\n    MDIconButton:\n        icon: "clock-time-eight-outline"\n        theme_text_color: "Custom"\n        text_color: (0, 0.5, 0.5, 1)\n        pos_hint: {"center_y": .5}\n        on_release: root.on_history()\n\n<MgmtEntityRecycleView>:\n    viewclass: \'MgmtEntityRecycleItem\'\n    RecycleBoxLayout:\n        default_size: None, dp(80)\n        default_size_hint: 1, None\n        size_hint_y: None\n        height: self.minimum_height\n        orientation: \'vertical\'\n        spacing: dp(2)\n        padding: dp(0)\n'
 # ==========================================
@@ -133,6 +154,2237 @@ class DataValidator:
             return False
         return len(ip_address) > 3
 
+class SearchText:
+    VERSION = '1'
+    FOLD = str.maketrans({**{chr(1632 + i): str(i) for i in range(10)}, **{chr(1776 + i): str(i) for i in range(10)}, 'ـ': None, 'ٱ': 'ا', 'ى': 'ي', 'ی': 'ي', 'ک': 'ك', 'ة': 'ه', 'œ': 'oe', 'æ': 'ae'})
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def normalize(text):
+        if not text:
+            return ''
+        decomposed = unicodedata.normalize('NFKD', str(text).casefold())
+        return ''.join((c for c in decomposed if not unicodedata.combining(c))).translate(SearchText.FOLD)
+
+    @staticmethod
+    def grams(text):
+        padded = f' {text} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def fuzzy_limit(token):
+        if len(token) < 4:
+            return 0
+        return 1 if len(token) < 8 else 2
+
+    @staticmethod
+    def edit_distance(a, b, limit):
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+        before = None
+        prev = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            cur = [i]
+            for j, cb in enumerate(b, 1):
+                cost = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+                if before is not None and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                    cost = min(cost, before[j - 2] + 1)
+                cur.append(cost)
+            if min(cur) > limit:
+                return limit + 1
+            before, prev = prev, cur
+        return min(prev[-1], limit + 1)
+
+class DisplayTextCache:
+
+    def __init__(self, shape, max_size=4096):
+        self.shape = shape
+        self.max_size = max_size
+        self.groups = {}
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        for group in list(self.groups.values()):
+            value = group.get(text)
+            if value is not None:
+                self.hits += 1
+                return value
+        with self.lock:
+            value = self.recent.get(text)
+            if value is not None:
+                self.recent.move_to_end(text)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = self.shape(text)
+        with self.lock:
+            self.recent[text] = value
+            if len(self.recent) > self.max_size:
+                self.recent.popitem(last=False)
+        return value
+
+    def pin(self, name, texts):
+        previous = self.groups.get(name, {})
+        shaped = {}
+        for text in texts:
+            if not text or text in shaped:
+                continue
+            value = previous.get(text)
+            if value is None:
+                with self.lock:
+                    value = self.recent.get(text)
+            shaped[text] = value if value is not None else self.shape(text)
+        self.groups[name] = shaped
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / total, 3) if total else 0, 'recent': len(self.recent), 'pinned': sum((len(g) for g in self.groups.values()))}
+
+class ProductTable:
+    TEXTS = ('id', 'name', 'barcode', 'product_ref')
+    NUMBERS = ('price', 'price_semi', 'price_wholesale', 'purchase_price', 'stock', 'stock_warehouse', 'tva')
+    KEYS = TEXTS + NUMBERS + ('has_promo',)
+    BITS = {key: 1 << i for i, key in enumerate(KEYS)}
+
+    def __init__(self):
+        self.texts = {key: [] for key in self.TEXTS}
+        self.numbers = {key: array('d') for key in self.NUMBERS}
+        self.promo = array('b')
+        self.present = array('H')
+        self.extra = {}
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.present)
+
+    @staticmethod
+    def _parse(value):
+        if value is None:
+            return math.nan
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def append(self, product):
+        row = len(self.present)
+        mask = 0
+        for key in self.TEXTS:
+            value = product.get(key)
+            if key in product:
+                mask |= self.BITS[key]
+            self.texts[key].append(sys.intern(value) if isinstance(value, str) else value)
+        for key in self.NUMBERS:
+            if key in product:
+                mask |= self.BITS[key]
+            self.numbers[key].append(self._parse(product.get(key)))
+        if 'has_promo' in product:
+            mask |= self.BITS['has_promo']
+        self.promo.append(1 if product.get('has_promo') else 0)
+        extra = {k: v for k, v in product.items() if k not in self.BITS}
+        if extra:
+            self.extra[row] = extra
+        self.present.append(mask)
+        return ProductRecord(self, row)
+
+    def extend(self, products):
+        return [self.append(p) for p in products]
+
+    def release(self, product):
+        if isinstance(product, ProductRecord) and product.table is self:
+            self.dead += 1
+
+    def needs_compaction(self):
+        return self.dead > max(1024, len(self.present) // 4)
+
+    def value(self, row, key, default=None):
+        bit = self.BITS.get(key)
+        if bit is None:
+            extra = self.extra.get(row)
+            return extra.get(key, default) if extra else default
+        if not self.present[row] & bit:
+            return default
+        column = self.numbers.get(key)
+        if column is not None:
+            value = column[row]
+            return None if value != value else value
+        if key == 'has_promo':
+            return bool(self.promo[row])
+        return self.texts[key][row]
+
+    def keys(self, row):
+        mask = self.present[row]
+        keys = [key for key in self.KEYS if mask & self.BITS[key]]
+        extra = self.extra.get(row)
+        if extra:
+            keys.extend(extra)
+        return keys
+
+    @staticmethod
+    def number(product, key):
+        if isinstance(product, ProductRecord):
+            return product.number(key)
+        try:
+            return float(product.get(key, 0) or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+class ProductRecord:
+    __slots__ = ('table', 'row')
+    MISSING = object()
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def get(self, key, default=None):
+        return self.table.value(self.row, key, default)
+
+    def __getitem__(self, key):
+        value = self.table.value(self.row, key, self.MISSING)
+        if value is self.MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.table.value(self.row, key, self.MISSING) is not self.MISSING
+
+    def keys(self):
+        return self.table.keys(self.row)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def number(self, key):
+        column = self.table.numbers.get(key)
+        if column is None:
+            return ProductTable.number(self.copy(), key)
+        value = column[self.row]
+        return 0.0 if value != value else value
+
+    @staticmethod
+    def json_default(obj):
+        if isinstance(obj, ProductRecord):
+            return obj.copy()
+        raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+class ProductRowCache:
+    SALE_MODES = ('sale', 'return_sale', 'invoice_sale', 'proforma')
+    AUTRE_MODES = ('sale', 'invoice_sale', 'proforma', 'order_purchase')
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.version = None
+        self.families = {'sale': {}, 'purchase': {}, 'transfer': {}}
+        self.products = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def family(cls, mode):
+        if mode == 'transfer':
+            return 'transfer'
+        if mode in cls.SALE_MODES:
+            return 'sale'
+        return 'purchase'
+
+    @staticmethod
+    def key(product):
+        pid = product.get('id')
+        return str(pid) if pid is not None else f'@{id(product)}'
+
+    @staticmethod
+    def fmt_qty(val):
+        try:
+            val = float(val)
+            if val.is_integer():
+                return str(int(val))
+            return str(val)
+        except:
+            return '0'
+
+    def sync(self, version):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                for rows in self.families.values():
+                    rows.clear()
+                self.products.clear()
+
+    def invalidate(self, ids, version=None):
+        with self.lock:
+            for pid in ids:
+                pid = str(pid)
+                for rows in self.families.values():
+                    rows.pop(pid, None)
+                self.products.pop(pid, None)
+            if version is not None:
+                self.version = version
+
+    def product(self, key):
+        return self.products.get(key)
+
+    def build(self, p, family):
+        fmt_qty = self.fmt_qty
+        s_store = ProductTable.number(p, 'stock')
+        s_wh = ProductTable.number(p, 'stock_warehouse')
+        total_stock = s_store + s_wh
+        if family == 'transfer' and total_stock < -900000:
+            return None
+        has_promo = family == 'sale' and p.get('has_promo', False)
+        if family == 'transfer':
+            price_fmt = f'Qnt Tot: {fmt_qty(total_stock)}'
+            price_color = [0.2, 0.2, 0.8, 1]
+            stock_text = f'Mag: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
+        else:
+            if family == 'sale':
+                price = ProductTable.number(p, 'price')
+                if has_promo:
+                    price_fmt = f'PROMO: {price:.2f} DA'
+                    price_color = [0.5, 0, 0.5, 1]
+                else:
+                    price_fmt = f'{price:.2f} DA'
+                    price_color = [0, 0.6, 0, 1]
+            else:
+                price = ProductTable.number(p, 'price' if p.get('purchase_price', 0) is None else 'purchase_price')
+                price_fmt = f'{price:.2f} DA'
+                price_color = [0.9, 0.5, 0, 1]
+            if total_stock < -900000:
+                stock_text = 'Illimité'
+            elif s_wh == 0:
+                stock_text = f'Qté: {fmt_qty(s_store)}'
+            else:
+                stock_text = f'Qté: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
+        in_stock = total_stock > 0 or total_stock < -900000
+        icon = 'sale' if has_promo else 'package-variant' if in_stock else 'package-variant-closed'
+        icon_col = [0, 0.6, 0, 1] if in_stock else [0.8, 0, 0, 1]
+        name = self.shape(str(p.get('name', 'Inconnu')))
+        return {'name': name, 'price_text': price_fmt, 'stock_text': stock_text, 'icon': icon, 'icon_color': icon_col, 'price_color': price_color, 'product_id': self.key(p)}
+
+    def rows(self, products, mode):
+        family = self.family(mode)
+        cached = self.families[family]
+        allow_autre = mode in self.AUTRE_MODES
+        out = []
+        for p in products:
+            key = self.key(p)
+            entry = cached.get(key)
+            if entry is None or entry[0] is not p:
+                try:
+                    entry = (p, self.build(p, family))
+                except Exception as e:
+                    print(f'Row Build Error: {e}')
+                    continue
+                cached[key] = entry
+            self.products[key] = p
+            row = entry[1]
+            if row is None:
+                continue
+            if not allow_autre and str(p.get('name', '')).lower().startswith('autre article'):
+                continue
+            out.append(row)
+        return out
+
+class ProductSearchIndex:
+
+    def __init__(self, products):
+        self.source = products
+        self.products = []
+        self.postings = {}
+        self.barcode_map = {}
+        self.ref_map = {}
+        self.slot_by_id = {}
+        self.lock = threading.RLock()
+        self._term_cache = {}
+        self._gram_index = None
+        self._code_grams = None
+        for p in products:
+            self._add(p)
+
+    @staticmethod
+    def _code_key(value):
+        if value is None:
+            return ''
+        return str(value).strip().lower()
+
+    @classmethod
+    def _keys(cls, product):
+        name = SearchText.normalize(product.get('name', ''))
+        return (set(name.split()), cls._code_key(product.get('barcode')), cls._code_key(product.get('product_ref')))
+
+    @classmethod
+    def matches(cls, product, query_clean, tokens):
+        terms, bar, ref = cls._keys(product)
+        if all((any((t in term for term in terms)) for t in tokens)):
+            return True
+        return bool(bar and query_clean in bar) or bool(ref and query_clean in ref)
+
+    def _add(self, product):
+        slot = len(self.products)
+        self.products.append(product)
+        self.slot_by_id.setdefault(str(product.get('id')), slot)
+        self._link(slot, product, append=True)
+
+    def _link(self, slot, product, append=False):
+        tokens, bar, ref = self._keys(product)
+        targets = [self.postings.setdefault(t, []) for t in tokens]
+        if bar:
+            targets.append(self.barcode_map.setdefault(bar, []))
+        if ref:
+            targets.append(self.ref_map.setdefault(ref, []))
+        for slots in targets:
+            if append:
+                slots.append(slot)
+            else:
+                bisect.insort(slots, slot)
+
+    def _unlink(self, slot, product):
+        tokens, bar, ref = self._keys(product)
+        for mapping, keys in ((self.postings, tokens), (self.barcode_map, [bar]), (self.ref_map, [ref])):
+            for key in keys:
+                slots = mapping.get(key)
+                if not slots:
+                    continue
+                i = bisect.bisect_left(slots, slot)
+                if i < len(slots) and slots[i] == slot:
+                    del slots[i]
+                if not slots:
+                    del mapping[key]
+
+    def add(self, product):
+        with self.lock:
+            self._term_cache = {}
+            self._gram_index = None
+            self._code_grams = None
+            self._add(product)
+
+    def update(self, product):
+        with self.lock:
+            self._term_cache = {}
+            self._gram_index = None
+            self._code_grams = None
+            slot = self.slot_by_id.get(str(product.get('id')))
+            if slot is None:
+                self._add(product)
+                return
+            self._unlink(slot, self.products[slot])
+            self.products[slot] = product
+            self._link(slot, product)
+
+    def remove(self, product_id):
+        with self.lock:
+            slot = self.slot_by_id.pop(str(product_id), None)
+            if slot is None:
+                return
+            self._term_cache = {}
+            self._gram_index = None
+            self._code_grams = None
+            self._unlink(slot, self.products[slot])
+            self.products[slot] = None
+
+    def _term_postings(self, token):
+        cached = self._term_cache.get(token)
+        if cached is not None:
+            return cached
+        lists = [slots for term, slots in self.postings.items() if token in term]
+        if len(self._term_cache) > 512:
+            self._term_cache.clear()
+        self._term_cache[token] = lists
+        return lists
+
+    def _fuzzy_postings(self, token):
+        limit = SearchText.fuzzy_limit(token)
+        if not limit:
+            return []
+        key = '~' + token
+        cached = self._term_cache.get(key)
+        if cached is not None:
+            return cached
+        if self._gram_index is None:
+            grams = {}
+            for term in self.postings:
+                for g in SearchText.grams(term):
+                    grams.setdefault(g, []).append(term)
+            self._gram_index = grams
+        token_grams = SearchText.grams(token)
+        counts = {}
+        for g in token_grams:
+            for term in self._gram_index.get(g, ()):
+                counts[term] = counts.get(term, 0) + 1
+        need = max(1, len(token_grams) - 4 * limit)
+        lists = []
+        for term, shared in counts.items():
+            if shared < need:
+                continue
+            if SearchText.edit_distance(token, term, limit) <= limit or (len(term) > len(token) and SearchText.edit_distance(token, term[:len(token)], limit) <= limit):
+                lists.append(self.postings[term])
+        self._term_cache[key] = lists
+        return lists
+
+    def _code_slots(self, query_clean):
+        slots = set()
+        if len(query_clean) < 3:
+            for code_map in (self.barcode_map, self.ref_map):
+                for code, code_slots in code_map.items():
+                    if query_clean in code:
+                        slots.update(code_slots)
+            return slots
+        if self._code_grams is None:
+            grams = {}
+            for code_map in (self.barcode_map, self.ref_map):
+                for code in code_map:
+                    for g in {code[i:i + 3] for i in range(len(code) - 2)}:
+                        grams.setdefault(g, []).append(code)
+            self._code_grams = grams
+        candidates = None
+        for i in range(len(query_clean) - 2):
+            codes = self._code_grams.get(query_clean[i:i + 3])
+            if not codes:
+                return slots
+            if candidates is None or len(codes) < len(candidates):
+                candidates = codes
+        for code in set(candidates):
+            if query_clean in code:
+                slots.update(self.barcode_map.get(code, ()))
+                slots.update(self.ref_map.get(code, ()))
+        return slots
+
+    def search(self, query, limit=50, fuzzy=False):
+        with self.lock:
+            return self._search(query, limit, fuzzy)
+
+    def _search(self, query, limit, fuzzy=False):
+        query_clean = SearchText.normalize(query).strip()
+        tokens = query_clean.split()
+        if not tokens:
+            results = []
+            for p in self.products:
+                if limit is not None and len(results) >= limit:
+                    break
+                if p is not None:
+                    results.append(p)
+            return results
+        exact = []
+        for code_map in (self.barcode_map, self.ref_map):
+            for slot in code_map.get(query_clean, ()):
+                if slot not in exact:
+                    exact.append(slot)
+        code_slots = self._code_slots(query_clean)
+        token_lists = [self._term_postings(t) or (self._fuzzy_postings(t) if fuzzy else []) for t in tokens]
+        driver = []
+        filters = []
+        if all(token_lists):
+            token_lists.sort(key=lambda lists: sum((len(l) for l in lists)))
+            driver = token_lists[0]
+            for lists in token_lists[1:]:
+                allowed = set()
+                for l in lists:
+                    allowed.update(l)
+                filters.append(allowed)
+        name_stream = heapq.merge(*driver) if driver else iter(())
+        stream = heapq.merge(name_stream, sorted(code_slots))
+        results = [self.products[s] for s in exact[:limit]]
+        seen = set(exact)
+        for slot in stream:
+            if limit is not None and len(results) >= limit:
+                break
+            if slot in seen:
+                continue
+            seen.add(slot)
+            if slot in code_slots or all((slot in f for f in filters)):
+                results.append(self.products[slot])
+        return results
+
+class QueryResultCache:
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.key = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.refined = 0
+        self.misses = 0
+
+    @staticmethod
+    def refines(old, new):
+        if old not in new:
+            return False
+        new_tokens = new.split()
+        return all((any((o in n for n in new_tokens)) for o in old.split()))
+
+    @staticmethod
+    def rank(products, query_clean, limit):
+        tokens = query_clean.split()
+        code_key = ProductSearchIndex._code_key
+
+        def tier(p):
+            if code_key(p.get('barcode')) == query_clean or code_key(p.get('product_ref')) == query_clean:
+                return 0
+            name = SearchText.normalize(p.get('name', ''))
+            if name.startswith(query_clean):
+                return 1
+            words = name.split()
+            if all((any((w.startswith(t) for w in words)) for t in tokens)):
+                return 2
+            return 3
+        return [p for _, _, p in heapq.nsmallest(limit, ((tier(p), i, p) for i, p in enumerate(products)))]
+
+    def bind(self, key):
+        with self.lock:
+            if key != self.key:
+                self.key = key
+                self.entries.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, query_clean):
+        with self.lock:
+            results = self.entries.get(query_clean)
+            if results is not None:
+                self.entries.move_to_end(query_clean)
+                self.hits += 1
+            return results
+
+    def base(self, query_clean):
+        with self.lock:
+            best = None
+            for old, results in self.entries.items():
+                if self.refines(old, query_clean) and (best is None or len(results) < len(best)):
+                    best = results
+            if best is not None:
+                self.refined += 1
+            else:
+                self.misses += 1
+            return best
+
+    def put(self, query_clean, results):
+        with self.lock:
+            self.entries[query_clean] = results
+            self.entries.move_to_end(query_clean)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'refined': self.refined, 'misses': self.misses, 'entries': len(self.entries)}
+
+class ProductResultCursor:
+
+    def __init__(self, kind, source, page_size=50, query=''):
+        self.kind = kind
+        self.source = source
+        self.page_size = page_size
+        self.query = query
+        self.position = 0
+        self.exhausted = False
+
+    def _fetch(self, start, end):
+        if self.kind == 'ranked':
+            return QueryResultCache.rank(self.source, self.query, end)[start:end]
+        if self.kind == 'catalogue':
+            return self.source.page(start, end - start)
+        if self.kind == 'catalogue_search':
+            return self.source.search(self.query, limit=end)[start:end]
+        return self.source[start:end]
+
+    def next_page(self):
+        if self.exhausted:
+            return []
+        start = self.position
+        items = self._fetch(start, start + self.page_size)
+        self.position = start + len(items)
+        if len(items) < self.page_size:
+            self.exhausted = True
+        return items
+
+    def rebase(self, products):
+        self.kind = 'list'
+        self.source = products
+        self.exhausted = self.position >= len(products)
+
+class BarcodeIndex:
+    VERSION = '2'
+    SEPARATORS = re.compile('[,;|]+')
+    GTIN_LENGTHS = (12, 13, 14)
+
+    def __init__(self, products):
+        self.source = products
+        self.codes = {}
+        for p in products:
+            self.add(p)
+
+    @classmethod
+    def lookup_keys(cls, code):
+        if code is None:
+            return []
+        key = str(code).strip().lower()
+        if not key:
+            return []
+        keys = [key]
+        if key.isdigit() and len(key) in cls.GTIN_LENGTHS:
+            keys.append('#' + (key.lstrip('0') or '0'))
+        return keys
+
+    @classmethod
+    def product_codes(cls, product):
+        raw = [product.get('barcode')]
+        extra = product.get('barcodes')
+        if isinstance(extra, (list, tuple)):
+            raw.extend(extra)
+        keys = []
+        for value in raw:
+            if value is None:
+                continue
+            for part in cls.SEPARATORS.split(str(value)):
+                for key in cls.lookup_keys(part):
+                    if key not in keys:
+                        keys.append(key)
+        return keys
+
+    def add(self, product):
+        for key in self.product_codes(product):
+            self.codes.setdefault(key, product)
+
+    def remove(self, product):
+        for key in self.product_codes(product):
+            if self.codes.get(key) is product:
+                del self.codes[key]
+
+    def lookup(self, code):
+        for key in self.lookup_keys(code):
+            found = self.codes.get(key)
+            if found is not None:
+                return found
+        return None
+
+class EntityIndex:
+    KINDS = ('clients', 'suppliers')
+
+    def __init__(self):
+        self.ids = {kind: {} for kind in self.KINDS}
+        self.names = {kind: {} for kind in self.KINDS}
+
+    @staticmethod
+    def name_key(name):
+        return SearchText.normalize(name).strip()
+
+    def set(self, kind, entities):
+        ids = {}
+        names = {}
+        for e in entities or []:
+            if e.get('id') is not None:
+                ids.setdefault(str(e.get('id')), e)
+            if e.get('name'):
+                names.setdefault(self.name_key(e.get('name')), e)
+        self.ids[kind] = ids
+        self.names[kind] = names
+
+    def kind_of(self, entity_id):
+        if entity_id is None:
+            return None
+        key = str(entity_id)
+        for kind in self.KINDS:
+            if key in self.ids[kind]:
+                return kind
+        return None
+
+    def get(self, entity_id, kind=None):
+        if kind is not None:
+            return self.ids[kind].get(str(entity_id)) if entity_id is not None else None
+        kind = self.kind_of(entity_id)
+        return self.ids[kind][str(entity_id)] if kind else None
+
+    def find_name(self, name):
+        if not name:
+            return None
+        key = self.name_key(name)
+        for kind in self.KINDS:
+            found = self.names[kind].get(key)
+            if found is not None:
+                return found
+        return None
+
+    def is_supplier(self, entity):
+        return entity is not None and self.ids['suppliers'].get(str(entity.get('id'))) is entity
+
+class ProductStreamBuild:
+
+    def __init__(self):
+        self.table = ProductTable()
+        self.products = []
+        self.index = ProductSearchIndex(self.products)
+        self.barcodes = BarcodeIndex(self.products)
+        self.first_page = None
+        self.streamed = False
+        self.store_ok = True
+
+    def add(self, items):
+        for p in items:
+            p = self.table.append(p)
+            self.products.append(p)
+            self.index.add(p)
+            self.barcodes.add(p)
+
+class CatalogueStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.fts_mode = None
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self._create_schema()
+            self._normalize_names()
+            self._rebuild_codes()
+
+    def _create_schema(self):
+        c = self.conn
+        c.execute('CREATE TABLE IF NOT EXISTS products (pos INTEGER PRIMARY KEY, id TEXT, name TEXT, name_lc TEXT, barcode TEXT, ref TEXT, price REAL, price_semi REAL, price_wholesale REAL, purchase_price REAL, stock REAL, stock_warehouse REAL, has_promo INTEGER, data TEXT)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_id ON products (id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_barcode ON products (barcode)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_ref ON products (ref)')
+        c.execute('CREATE TABLE IF NOT EXISTS product_codes (code TEXT, pos INTEGER)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_product_codes_code ON product_codes (code)')
+        c.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        try:
+            c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(name, tokenize='trigram')")
+            self.fts_mode = 'trigram'
+        except sqlite3.OperationalError:
+            self.fts_mode = None
+        c.commit()
+
+    def _normalize_names(self):
+        if self.get_meta('name_norm') == SearchText.VERSION:
+            return
+        c = self.conn
+        c.create_function('search_norm', 1, SearchText.normalize)
+        c.execute('UPDATE products SET name_lc = search_norm(name)')
+        if self.fts_mode:
+            c.execute('DELETE FROM products_fts')
+            c.execute('INSERT INTO products_fts (rowid, name) SELECT pos, name_lc FROM products')
+        self._set_meta('name_norm', SearchText.VERSION)
+        c.commit()
+
+    def _rebuild_codes(self):
+        if self.get_meta('codes_norm') == BarcodeIndex.VERSION:
+            return
+        c = self.conn
+        c.execute('DELETE FROM product_codes')
+        for pos, data in c.execute('SELECT pos, data FROM products').fetchall():
+            try:
+                product = json.loads(data)
+            except ValueError:
+                continue
+            c.executemany('INSERT INTO product_codes (code, pos) VALUES (?, ?)', [(code, pos) for code in BarcodeIndex.product_codes(product)])
+        self._set_meta('codes_norm', BarcodeIndex.VERSION)
+        c.commit()
+
+    @staticmethod
+    def _num(value):
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _row(self, pos, p):
+        return (pos, str(p.get('id')), str(p.get('name', '')), SearchText.normalize(p.get('name', '')), str(p.get('barcode', '') or '').strip().lower(), str(p.get('product_ref', '') or '').strip().lower(), self._num(p.get('price')), self._num(p.get('price_semi')), self._num(p.get('price_wholesale')), self._num(p.get('purchase_price')), self._num(p.get('stock')), self._num(p.get('stock_warehouse')), 1 if p.get('has_promo') else 0, json.dumps(p, ensure_ascii=False, default=ProductRecord.json_default))
+
+    def _insert(self, pos, p):
+        row = self._row(pos, p)
+        self.conn.execute('INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        self.conn.executemany('INSERT INTO product_codes (code, pos) VALUES (?, ?)', [(code, pos) for code in BarcodeIndex.product_codes(p)])
+        if self.fts_mode:
+            self.conn.execute('INSERT INTO products_fts (rowid, name) VALUES (?, ?)', (pos, row[3]))
+
+    def _delete_pos(self, pos):
+        self.conn.execute('DELETE FROM products WHERE pos = ?', (pos,))
+        self.conn.execute('DELETE FROM product_codes WHERE pos = ?', (pos,))
+        if self.fts_mode:
+            self.conn.execute('DELETE FROM products_fts WHERE rowid = ?', (pos,))
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def begin_replace(self):
+        with self.lock:
+            self.conn.rollback()
+            self.conn.execute('DELETE FROM products')
+            self.conn.execute('DELETE FROM product_codes')
+            if self.fts_mode:
+                self.conn.execute('DELETE FROM products_fts')
+
+    def append_rows(self, start_pos, products):
+        with self.lock:
+            try:
+                for offset, p in enumerate(products):
+                    self._insert(start_pos + offset, p)
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def commit_replace(self, version=None):
+        with self.lock:
+            self._set_meta('version', version or '')
+            self.conn.commit()
+
+    def abort_replace(self):
+        with self.lock:
+            self.conn.rollback()
+
+    def replace_all(self, products, version=None):
+        with self.lock:
+            try:
+                self.begin_replace()
+                self.append_rows(0, products)
+                self.commit_replace(version)
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def apply_delta(self, changed, deleted, version=None):
+        with self.lock:
+            try:
+                for product_id in deleted:
+                    row = self.conn.execute('SELECT pos FROM products WHERE id = ?', (str(product_id),)).fetchone()
+                    if row:
+                        self._delete_pos(row[0])
+                next_pos = (self.conn.execute('SELECT MAX(pos) FROM products').fetchone()[0] or 0) + 1
+                for p in changed:
+                    row = self.conn.execute('SELECT pos FROM products WHERE id = ?', (str(p.get('id')),)).fetchone()
+                    if row:
+                        pos = row[0]
+                        self._delete_pos(pos)
+                    else:
+                        pos = next_pos
+                        next_pos += 1
+                    self._insert(pos, p)
+                self._set_meta('version', version or '')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def _load(self, sql, params=()):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def load_all(self):
+        return self._load('SELECT data FROM products ORDER BY pos')
+
+    def page(self, offset, limit):
+        return self._load('SELECT data FROM products ORDER BY pos LIMIT ? OFFSET ?', (limit, offset))
+
+    def lookup_barcode(self, code):
+        for key in BarcodeIndex.lookup_keys(code):
+            found = self._load('SELECT p.data FROM product_codes c JOIN products p ON p.pos = c.pos WHERE c.code = ? ORDER BY p.pos LIMIT 1', (key,))
+            if found:
+                return found[0]
+        return None
+
+    @staticmethod
+    def _like(text):
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return f'%{escaped}%'
+
+    def search(self, query, limit=50):
+        query_clean = SearchText.normalize(query).strip()
+        tokens = query_clean.split()
+        if not tokens:
+            return self.page(0, limit)
+        name_conds = []
+        params = []
+        fts_tokens = [t for t in tokens if self.fts_mode == 'trigram' and len(t) >= 3]
+        if fts_tokens:
+            name_conds.append('pos IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)')
+            params.append(' AND '.join(('"' + t.replace('"', '""') + '"' for t in fts_tokens)))
+        for t in tokens:
+            if t not in fts_tokens:
+                name_conds.append("name_lc LIKE ? ESCAPE '\\'")
+                params.append(self._like(t))
+        like_query = self._like(query_clean)
+        where = f"({' AND '.join(name_conds)}) OR barcode LIKE ? ESCAPE '\\' OR ref LIKE ? ESCAPE '\\'"
+        params.extend([like_query, like_query])
+        exact = self._load('SELECT data FROM products WHERE barcode = ? OR ref = ? ORDER BY pos LIMIT ?', (query_clean, query_clean, limit))
+        results = self._load(f'SELECT data FROM products WHERE {where} ORDER BY pos LIMIT ?', params + [limit + len(exact)])
+        seen = set((str(p.get('id')) for p in exact))
+        merged = list(exact)
+        for p in results:
+            if len(merged) >= limit:
+                break
+            if str(p.get('id')) not in seen:
+                merged.append(p)
+        return merged
+
+class EntityHistoryCache:
+
+    def __init__(self, path, max_entries=400):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS entity_history (kind TEXT, entity_id TEXT, day TEXT, next_offset INTEGER, fetched REAL, data TEXT, PRIMARY KEY (kind, entity_id, day))')
+            self.conn.commit()
+
+    def get(self, kind, entity_id, day):
+        with self.lock:
+            row = self.conn.execute('SELECT next_offset, fetched, data FROM entity_history WHERE kind = ? AND entity_id = ? AND day = ?', (kind, str(entity_id), day)).fetchone()
+        if row is None:
+            return None
+        try:
+            items = json.loads(row[2])
+        except ValueError:
+            return None
+        return {'items': items, 'next': row[0], 'fetched': row[1]}
+
+    def put(self, kind, entity_id, day, items, next_offset=None):
+        with self.lock:
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO entity_history (kind, entity_id, day, next_offset, fetched, data) VALUES (?, ?, ?, ?, ?, ?)', (kind, str(entity_id), day, next_offset, time.time(), json.dumps(items, ensure_ascii=False)))
+                self.conn.execute('DELETE FROM entity_history WHERE rowid NOT IN (SELECT rowid FROM entity_history ORDER BY fetched DESC LIMIT ?)', (self.max_entries,))
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                print(f'History Cache Error: {e}')
+
+    def invalidate(self, kind, entity_id):
+        with self.lock:
+            self.conn.execute('UPDATE entity_history SET fetched = 0 WHERE kind = ? AND entity_id = ?', (kind, str(entity_id)))
+            self.conn.commit()
+
+class OfflineJournal:
+
+    def __init__(self, path, legacy_path=None, compact_min=200):
+        self.path = path
+        self.compact_min = compact_min
+        self.lock = threading.RLock()
+        self.items = {}
+        self.records = 0
+        self._pending = []
+        self._parked = set()
+        self._fh = None
+        with self.lock:
+            if os.path.exists(self.path):
+                self._replay()
+            elif legacy_path and os.path.exists(legacy_path):
+                self._migrate(legacy_path)
+            self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        clean = True
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line.decode('utf-8'))
+                    if not isinstance(rec, dict) or not isinstance(rec.get('value', {}), dict):
+                        raise ValueError('bad record')
+                except ValueError:
+                    clean = False
+                    continue
+                self._apply(rec)
+                self.records += 1
+        if not clean:
+            shutil.copyfile(self.path, f'{self.path}.corrupt-{int(time.time())}')
+            self._write_snapshot()
+
+    def _migrate(self, legacy_path):
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for key, value in data.items():
+                self._apply({'op': 'put', 'key': key, 'value': value})
+            self._write_snapshot()
+            os.replace(legacy_path, legacy_path + '.bak')
+        except Exception as e:
+            print(f'Journal Migration Error: {e}')
+
+    @staticmethod
+    def key_timestamp(key):
+        head = str(key).split('_')[0]
+        return int(head) if head.isdigit() else 0
+
+    def _mark_pending(self, key, pending):
+        entry = (self.key_timestamp(key), key)
+        i = bisect.bisect_left(self._pending, entry)
+        present = i < len(self._pending) and self._pending[i] == entry
+        if pending and (not present):
+            self._pending.insert(i, entry)
+        elif present and (not pending):
+            del self._pending[i]
+
+    def _apply(self, rec):
+        op = rec.get('op')
+        key = rec.get('key')
+        if op == 'put':
+            value = rec.get('value', {})
+            self.items[key] = value
+            self._mark_pending(key, not value.get('synced', False))
+            if value.get('parked'):
+                self._parked.add(key)
+            else:
+                self._parked.discard(key)
+        elif op == 'ack':
+            item = self.items.get(key)
+            if item is not None:
+                item['synced'] = True
+                item['sync_timestamp'] = rec.get('ts', 0)
+                item.pop('parked', None)
+                item.setdefault('order_data', {}).update(rec.get('order', {}))
+                self._mark_pending(key, False)
+                self._parked.discard(key)
+        elif op == 'park':
+            item = self.items.get(key)
+            if item is not None:
+                item['parked'] = True
+                item['sync_error'] = rec.get('error', '')
+                self._parked.add(key)
+        elif op == 'unpark':
+            item = self.items.get(key)
+            if item is not None:
+                item.pop('parked', None)
+                self._parked.discard(key)
+        elif op == 'del':
+            if self.items.pop(key, None) is not None:
+                self._mark_pending(key, False)
+                self._parked.discard(key)
+
+    def _append(self, rec):
+        self._apply(rec)
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + '\n')
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.records += 1
+        if self.records > max(self.compact_min, 2 * len(self.items)):
+            self.compact()
+
+    def _write_snapshot(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, value in self.items.items():
+                f.write(json.dumps({'op': 'put', 'key': key, 'value': value}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.records = len(self.items)
+
+    def compact(self):
+        with self.lock:
+            if self._fh:
+                self._fh.close()
+            try:
+                self._write_snapshot()
+            finally:
+                self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def keys(self):
+        with self.lock:
+            return list(self.items.keys())
+
+    def exists(self, key):
+        return key in self.items
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def synced_count(self):
+        return len(self.items) - len(self._pending)
+
+    def parked_count(self):
+        return len(self._parked)
+
+    def pending_keys(self, limit=None):
+        with self.lock:
+            entries = self._pending if limit is None else self._pending[:limit]
+            return [key for ts, key in entries]
+
+    def pending_keys_between(self, start_ts, end_ts):
+        with self.lock:
+            lo = bisect.bisect_left(self._pending, (start_ts, ''))
+            hi = bisect.bisect_left(self._pending, (end_ts, ''))
+            return [key for ts, key in self._pending[lo:hi]]
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                raise KeyError(key)
+            return self.items[key]
+
+    def put(self, key, **values):
+        with self.lock:
+            self._append({'op': 'put', 'key': key, 'value': values})
+
+    def enqueue(self, key, order_data, synced=False):
+        self.put(key, order_data=order_data, synced=synced, sync_timestamp=time.time() if synced else 0)
+
+    def ack(self, key, **order_updates):
+        with self.lock:
+            if key in self.items:
+                updates = {k: v for k, v in order_updates.items() if v}
+                self._append({'op': 'ack', 'key': key, 'ts': time.time(), 'order': updates})
+
+    def park(self, key, error=''):
+        with self.lock:
+            if key in self.items:
+                self._append({'op': 'park', 'key': key, 'error': str(error or '')})
+
+    def unpark_all(self):
+        with self.lock:
+            for key in list(self._parked):
+                self._append({'op': 'unpark', 'key': key})
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.items:
+                raise KeyError(key)
+            self._append({'op': 'del', 'key': key})
+
+    def close(self):
+        with self.lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+class BalanceJournal:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.entries = []
+        self.seq = 0
+        self._fh = None
+        with self.lock:
+            if os.path.exists(self.path):
+                self._replay()
+            self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def _replay(self):
+        clean = True
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line.decode('utf-8'))
+                    seq = int(rec.get('seq', 0))
+                    if rec.get('op') == 'delta':
+                        if 'kind' not in rec or 'id' not in rec:
+                            raise ValueError('bad record')
+                        rec['seq'] = seq
+                        rec['delta'] = float(rec['delta'])
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    clean = False
+                    continue
+                self.seq = max(self.seq, seq)
+                if rec.get('op') == 'delta':
+                    self.entries.append(rec)
+        if not clean:
+            shutil.copyfile(self.path, f'{self.path}.corrupt-{int(time.time())}')
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'op': 'seq', 'seq': self.seq}) + '\n')
+            for rec in self.entries:
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def record(self, kind, entity_id, delta):
+        with self.lock:
+            self.seq += 1
+            rec = {'op': 'delta', 'seq': self.seq, 'kind': kind, 'id': entity_id, 'delta': delta}
+            self.entries.append(rec)
+            self._fh.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            return self.seq
+
+    def last_seq(self):
+        return self.seq
+
+    def pending(self, kind, after_seq=0):
+        with self.lock:
+            return [(rec['id'], rec['delta']) for rec in self.entries if rec['kind'] == kind and rec['seq'] > after_seq]
+
+    def truncate(self, kind, upto_seq):
+        with self.lock:
+            kept = [rec for rec in self.entries if rec['kind'] != kind or rec['seq'] > upto_seq]
+            if len(kept) == len(self.entries):
+                return
+            self.entries = kept
+            if self._fh:
+                self._fh.close()
+            try:
+                self._write_snapshot()
+            finally:
+                self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+class SyncScheduler:
+
+    def __init__(self, max_in_flight=2, base_delay=2.0, max_delay=300.0, park_after=5):
+        self.max_in_flight = max_in_flight
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.park_after = park_after
+        self.requests = 0
+        self.in_flight = {}
+        self.busy_lanes = {}
+        self.rejects = {}
+        self.next_at = {}
+        self.transport_failures = 0
+        self.hold_until = 0
+
+    @staticmethod
+    def lane(key, data):
+        entity_id = data.get('entity_id')
+        if entity_id in (None, ''):
+            return f'key:{key}'
+        return f'entity:{entity_id}'
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** max(attempts - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def has_capacity(self, now):
+        return self.requests < self.max_in_flight and now >= self.hold_until
+
+    def next_batch(self, journal, now, limit):
+        if not self.has_capacity(now):
+            return []
+        selected = []
+        blocked = set(self.busy_lanes)
+        for key in journal.pending_keys():
+            try:
+                item = journal.get(key)
+            except KeyError:
+                continue
+            if item.get('parked'):
+                continue
+            lane = self.lane(key, item.get('order_data', {}))
+            if lane in blocked:
+                continue
+            if self.next_at.get(key, 0) > now:
+                blocked.add(lane)
+                continue
+            selected.append((key, lane))
+            blocked.add(lane)
+            if len(selected) >= limit:
+                break
+        return selected
+
+    def start(self, selected):
+        self.requests += 1
+        for key, lane in selected:
+            self.in_flight[key] = lane
+            self.busy_lanes[lane] = self.busy_lanes.get(lane, 0) + 1
+
+    def request_done(self):
+        self.requests = max(self.requests - 1, 0)
+
+    def release(self, key):
+        lane = self.in_flight.pop(key, None)
+        if lane is None:
+            return
+        left = self.busy_lanes.get(lane, 1) - 1
+        if left > 0:
+            self.busy_lanes[lane] = left
+        else:
+            self.busy_lanes.pop(lane, None)
+
+    def succeeded(self, key):
+        self.release(key)
+        self.rejects.pop(key, None)
+        self.next_at.pop(key, None)
+        self.transport_failures = 0
+
+    def rejected(self, key, now):
+        self.release(key)
+        count = self.rejects.get(key, 0) + 1
+        self.rejects[key] = count
+        self.transport_failures = 0
+        if count >= self.park_after:
+            self.rejects.pop(key, None)
+            self.next_at.pop(key, None)
+            return True
+        self.next_at[key] = now + self.backoff(count)
+        return False
+
+    def transport_failed(self, keys, now):
+        for key in keys:
+            self.release(key)
+        self.transport_failures += 1
+        self.hold_until = now + self.backoff(self.transport_failures)
+
+    def next_wakeup(self, now):
+        times = [t for t in self.next_at.values() if t > now]
+        if self.hold_until > now:
+            times.append(self.hold_until)
+        return min(times) - now if times else None
+
+    def reset(self):
+        self.rejects.clear()
+        self.next_at.clear()
+        self.transport_failures = 0
+        self.hold_until = 0
+
+class JsonArrayStream:
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.mode = None
+        self.closed = False
+
+    def feed(self, data, final=False):
+        self.buf += self.text.decode(data, final)
+        items = []
+        if self.mode is None:
+            stripped = self.buf.lstrip()
+            if not stripped:
+                return items
+            if stripped[0] == '[':
+                self.mode = 'array'
+                self.buf = stripped[1:]
+            else:
+                self.mode = 'value'
+        if self.mode != 'array':
+            return items
+        buf = self.buf
+        n = len(buf)
+        pos = 0
+        while not self.closed:
+            while pos < n and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= n:
+                break
+            if buf[pos] == ']':
+                self.closed = True
+                pos += 1
+                break
+            try:
+                value, end = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            if end >= n and (not final) and (buf[end - 1] not in '}]"'):
+                break
+            items.append(value)
+            pos = end
+        self.buf = buf[pos:]
+        if final and (not self.closed or self.buf.strip()):
+            raise ValueError('Truncated JSON array')
+        return items
+
+    def value(self):
+        return json.loads(self.buf) if self.buf.strip() else None
+
+class ApiRequest:
+
+    def __init__(self, url, method, req_body, req_headers):
+        self.url = url
+        self.method = method
+        self.req_body = req_body
+        self.req_headers = req_headers
+        self.resp_status = None
+        self.resp_headers = {}
+        self.result = None
+        self.error = None
+        self.compress = False
+        self.is_finished = False
+        self.host = None
+        self.tried = set()
+        self.ttfb = None
+        self.coalesce_key = None
+        self.epoch = 0
+        self.waiters = None
+
+class EndpointManager:
+
+    def __init__(self, switch_ratio=0.7, switch_after=3, alpha=0.2):
+        self.switch_ratio = switch_ratio
+        self.switch_after = switch_after
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.hosts = []
+        self.links = {}
+        self.preferred = None
+        self.challenger = None
+        self.streak = 0
+        self.switches = 0
+
+    def set_hosts(self, hosts):
+        hosts = [h for h in dict.fromkeys(hosts) if h]
+        with self.lock:
+            self.links = {h: self.links.get(h) or {'up': None, 'rtt': 0.0, 'latency': 0.0, 'errors': 0.0, 'requests': 0, 'failures': 0} for h in hosts}
+            self.hosts = hosts
+            if self.preferred not in self.links:
+                self.preferred = hosts[0] if hosts else None
+                self.challenger = None
+                self.streak = 0
+
+    def route(self, host):
+        with self.lock:
+            return self.preferred if host in self.links and self.preferred else None
+
+    def _score(self, host):
+        link = self.links[host]
+        if link['up'] is None and not link['requests']:
+            return float('inf')
+        latency = link['latency'] if link['requests'] else link['rtt']
+        return (latency + 5.0) * (1 + 4 * link['errors'])
+
+    def observe_health(self, links):
+        with self.lock:
+            for host, info in links.items():
+                link = self.links.get(host)
+                if link is not None:
+                    link['up'] = info['up']
+                    if info['up']:
+                        link['rtt'] = info['rtt']
+            return any((link['up'] for link in self.links.values()))
+
+    def observe(self, host, latency, ok=True):
+        with self.lock:
+            link = self.links.get(host)
+            if link is None:
+                return
+            link['errors'] = link['errors'] * (1 - self.alpha) + (0.0 if ok else self.alpha)
+            if latency is None:
+                link['up'] = False
+                link['failures'] += 1
+                if host == self.preferred:
+                    self._switch(self._best(exclude=(host,)))
+                return
+            link['latency'] = latency if not link['requests'] else link['latency'] * (1 - self.alpha) + latency * self.alpha
+            link['requests'] += 1
+
+    def _best(self, exclude=()):
+        candidates = [h for h in self.hosts if h not in exclude and self.links[h]['up'] is not False]
+        return min(candidates, key=self._score) if candidates else None
+
+    def _switch(self, host):
+        if host is not None and host != self.preferred:
+            self.preferred = host
+            self.switches += 1
+        self.challenger = None
+        self.streak = 0
+
+    def select(self):
+        with self.lock:
+            if self.preferred is None or self.links[self.preferred]['up'] is False:
+                self._switch(self._best())
+                return self.preferred
+            best = self._best()
+            if best is None or best == self.preferred or self._score(best) >= self._score(self.preferred) * self.switch_ratio:
+                self.challenger = None
+                self.streak = 0
+                return self.preferred
+            if best != self.challenger:
+                self.challenger = best
+                self.streak = 0
+            self.streak += 1
+            if self.streak >= self.switch_after:
+                self._switch(best)
+            return self.preferred
+
+    def alternate(self, tried):
+        with self.lock:
+            return self._best(exclude=tried)
+
+    def stats(self):
+        with self.lock:
+            links = {host: {'up': link['up'], 'score': round(min(self._score(host), 1e9), 1), 'latency_ms': round(link['latency'], 1), 'errors': round(link['errors'], 3), 'requests': link['requests'], 'failures': link['failures']} for host, link in self.links.items()}
+            return {'preferred': self.preferred, 'switches': self.switches, 'links': links}
+
+class ApiClient:
+    RETRYABLE = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+    GZIP_MIN_BYTES = 1024
+
+    def __init__(self, max_workers=4, max_idle=4, idle_timeout=5.0, default_timeout=20, gzip_upload=False, endpoints=None, freshness=2.0):
+        self.endpoints = endpoints
+        self.freshness = freshness
+        self.inflight = {}
+        self.recent = {}
+        self.write_epoch = 0
+        self.coalesced = 0
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.default_timeout = default_timeout
+        self.gzip_upload = gzip_upload
+        self.gzip_refused = set()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = {}
+
+    def _acquire(self, host, port, timeout):
+        now = time.time()
+        with self.lock:
+            pool = self.idle.get((host, port), [])
+            while pool:
+                conn, since = pool.pop()
+                if now - since <= self.idle_timeout:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return (conn, True)
+                conn.close()
+        return (http.client.HTTPConnection(host, port, timeout=timeout), False)
+
+    def _release(self, host, port, conn):
+        with self.lock:
+            pool = self.idle.setdefault((host, port), [])
+            if len(pool) < self.max_idle:
+                pool.append((conn, time.time()))
+                return
+        conn.close()
+
+    def adopt(self, host, port, sock):
+        conn = http.client.HTTPConnection(host, port)
+        sock.setblocking(True)
+        conn.sock = sock
+        self._release(host, port, conn)
+
+    def close_idle(self):
+        with self.lock:
+            pools = list(self.idle.values())
+            self.idle = {}
+        for pool in pools:
+            for conn, since in pool:
+                conn.close()
+
+    def request(self, url, req_body=None, req_headers=None, method=None, on_success=None, on_failure=None, on_error=None, on_redirect=None, timeout=None, compress=False, coalesce=False):
+        req = ApiRequest(url, method or ('POST' if req_body is not None else 'GET'), req_body, dict(req_headers or {}))
+        req.compress = compress
+        callbacks = (on_success, on_failure, on_error, on_redirect)
+        if req.method not in ('GET', 'HEAD'):
+            self._note_write()
+        elif coalesce:
+            key = (req.method, url, tuple(sorted(req.req_headers.items())))
+            with self.lock:
+                recent = self.recent.get(key)
+                shared = recent[0] if recent and time.monotonic() - recent[1] <= self.freshness else None
+                if shared is None:
+                    shared = self.inflight.get(key)
+                    if shared is not None:
+                        shared.waiters.append(callbacks)
+                        self.coalesced += 1
+                        return shared
+                    req.coalesce_key = key
+                    req.epoch = self.write_epoch
+                    req.waiters = [callbacks]
+                    self.inflight[key] = req
+                else:
+                    self.coalesced += 1
+            if shared is not None:
+                self._deliver(shared, callbacks)
+                return shared
+        self.executor.submit(self._run, req, callbacks, timeout or self.default_timeout)
+        return req
+
+    def _note_write(self):
+        with self.lock:
+            self.write_epoch += 1
+            self.inflight.clear()
+            self.recent.clear()
+
+    def stamp(self, epoch=None):
+        return (self.write_epoch if epoch is None else epoch, time.monotonic())
+
+    def is_fresh(self, stamp):
+        return bool(stamp) and stamp[0] == self.write_epoch and time.monotonic() - stamp[1] <= self.freshness
+
+    @staticmethod
+    def _target(req):
+        parsed = urlparse(req.url)
+        path = (parsed.path or '/') + (f'?{parsed.query}' if parsed.query else '')
+        headers = dict(req.req_headers)
+        if not any((k.lower() == 'accept-encoding' for k in headers)):
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        return (req.host or parsed.hostname, parsed.port or 80, path, parsed.path, headers)
+
+    def _route(self, req):
+        if self.endpoints is not None:
+            req.host = self.endpoints.route(urlparse(req.url).hostname)
+
+    def _observe(self, req):
+        if req.host is not None and req.ttfb is not None:
+            self.endpoints.observe(req.host, req.ttfb * 1000, req.resp_status < 500)
+
+    def _failover(self, req, error):
+        host = req.host
+        if host is None or not isinstance(error, (OSError, http.client.HTTPException)):
+            return False
+        self.endpoints.observe(host, None, False)
+        if req.method not in ('GET', 'HEAD'):
+            return False
+        req.tried.add(host)
+        alt = self.endpoints.alternate(req.tried)
+        if alt is None:
+            return False
+        req.host = alt
+        req.resp_status = None
+        req.resp_headers = {}
+        return True
+
+    def _send(self, req, timeout):
+        start = time.time()
+        host, port, path, endpoint, headers = self._target(req)
+        raw_body = req.req_body
+        if isinstance(raw_body, str):
+            raw_body = raw_body.encode('utf-8')
+        body = raw_body
+        zipped = bool(req.compress and self.gzip_upload and raw_body and len(raw_body) >= self.GZIP_MIN_BYTES and (host, port) not in self.gzip_refused)
+        if zipped:
+            body = gzip.compress(raw_body)
+            headers['Content-Encoding'] = 'gzip'
+        data = self._exchange(req, host, port, path, body, headers, timeout)
+        if zipped and req.resp_status == 415:
+            self.gzip_refused.add((host, port))
+            headers.pop('Content-Encoding', None)
+            body = raw_body
+            data = self._exchange(req, host, port, path, body, headers, timeout)
+        wire_in = len(data)
+        data = self._decompress(req.resp_headers, data)
+        self._record(endpoint, len(raw_body or b''), len(body or b''), len(data), wire_in, time.time() - start)
+        return data
+
+    def stream(self, url, req_headers=None, on_items=None, on_success=None, on_failure=None, on_error=None, on_redirect=None, timeout=None, batch_size=200):
+        req = ApiRequest(url, 'GET', None, dict(req_headers or {}))
+        callbacks = (on_success, on_failure, on_error, on_redirect)
+        self.executor.submit(self._run_stream, req, on_items, callbacks, timeout or self.default_timeout, batch_size)
+        return req
+
+    @staticmethod
+    def _stream_decompressor(resp_headers):
+        encoding = ''
+        for k, v in resp_headers.items():
+            if k.lower() == 'content-encoding':
+                encoding = v.lower().strip()
+        if encoding in ('gzip', 'x-gzip'):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            return zlib.decompressobj()
+        return None
+
+    def _run_stream(self, req, on_items, callbacks, timeout, batch_size):
+        on_success, on_failure, on_error, on_redirect = callbacks
+        start = time.time()
+        self._route(req)
+        emitted = False
+        while True:
+            host, port, path, endpoint, headers = self._target(req)
+            wire_in = 0
+            raw_in = 0
+            try:
+                conn, resp = self._open(req, host, port, path, None, headers, timeout)
+                try:
+                    if resp.status >= 300:
+                        data = resp.read()
+                        wire_in = len(data)
+                        data = self._decompress(req.resp_headers, data)
+                        raw_in = len(data)
+                        req.result = self._decode(req, data)
+                    else:
+                        decomp = self._stream_decompressor(req.resp_headers)
+                        parser = JsonArrayStream()
+                        collected = []
+                        pending = []
+                        while True:
+                            chunk = resp.read(16384)
+                            if not chunk:
+                                break
+                            wire_in += len(chunk)
+                            if decomp is not None:
+                                try:
+                                    chunk = decomp.decompress(chunk)
+                                except zlib.error:
+                                    if wire_in != len(chunk):
+                                        raise
+                                    decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+                                    chunk = decomp.decompress(chunk)
+                            raw_in += len(chunk)
+                            pending.extend(parser.feed(chunk))
+                            if on_items is not None and len(pending) >= batch_size:
+                                on_items(req, pending)
+                                emitted = True
+                                collected.extend(pending)
+                                pending = []
+                        tail = decomp.flush() if decomp is not None else b''
+                        raw_in += len(tail)
+                        pending.extend(parser.feed(tail, final=True))
+                        if parser.mode == 'array':
+                            if on_items is not None and pending:
+                                on_items(req, pending)
+                            collected.extend(pending)
+                            req.result = collected
+                        else:
+                            req.result = parser.value()
+                except Exception:
+                    conn.close()
+                    raise
+                self._finish(host, port, conn, resp)
+                break
+            except Exception as e:
+                if not emitted and self._failover(req, e):
+                    continue
+                req.error = e
+                req.is_finished = True
+                self._dispatch(on_error, req, e)
+                return
+        self._observe(req)
+        self._record(endpoint, 0, 0, raw_in, wire_in, time.time() - start)
+        req.is_finished = True
+        status = req.resp_status
+        if status >= 400:
+            self._dispatch(on_failure, req, req.result)
+        elif status >= 300:
+            self._dispatch(on_redirect, req, req.result)
+        else:
+            self._dispatch(on_success, req, req.result)
+
+    def _open(self, req, host, port, path, body, headers, timeout):
+        for attempt in (0, 1):
+            conn, reused = self._acquire(host, port, timeout)
+            sent = False
+            start = time.time()
+            try:
+                conn.request(req.method, path, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                req.ttfb = time.time() - start
+            except self.RETRYABLE:
+                conn.close()
+                if reused and attempt == 0 and (not sent or req.method in ('GET', 'HEAD')):
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            req.resp_status = resp.status
+            req.resp_headers = dict(resp.getheaders())
+            return (conn, resp)
+
+    def _finish(self, host, port, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(host, port, conn)
+
+    def _exchange(self, req, host, port, path, body, headers, timeout):
+        conn, resp = self._open(req, host, port, path, body, headers, timeout)
+        try:
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        self._finish(host, port, conn, resp)
+        return data
+
+    @staticmethod
+    def _decompress(resp_headers, data):
+        encoding = ''
+        for k, v in resp_headers.items():
+            if k.lower() == 'content-encoding':
+                encoding = v.lower().strip()
+        if not data or not encoding:
+            return data
+        if encoding in ('gzip', 'x-gzip'):
+            return gzip.decompress(data)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def _record(self, endpoint, sent_raw, sent_wire, recv_raw, recv_wire, elapsed):
+        with self.lock:
+            entry = self.stats.setdefault(endpoint, {'count': 0, 'sent_raw': 0, 'sent_wire': 0, 'recv_raw': 0, 'recv_wire': 0, 'ms': 0})
+            entry['count'] += 1
+            entry['sent_raw'] += sent_raw
+            entry['sent_wire'] += sent_wire
+            entry['recv_raw'] += recv_raw
+            entry['recv_wire'] += recv_wire
+            entry['ms'] += int(elapsed * 1000)
+
+    def load_stats(self, stats):
+        with self.lock:
+            for endpoint, values in (stats or {}).items():
+                entry = self.stats.setdefault(endpoint, {'count': 0, 'sent_raw': 0, 'sent_wire': 0, 'recv_raw': 0, 'recv_wire': 0, 'ms': 0})
+                for k in entry:
+                    entry[k] += int(values.get(k, 0) or 0)
+
+    def stats_snapshot(self):
+        with self.lock:
+            return {endpoint: dict(values) for endpoint, values in self.stats.items()}
+
+    TEXT_TYPES = ('json', 'text/', 'xml', 'javascript', 'x-www-form-urlencoded')
+
+    def _decode(self, req, data):
+        content_type = ''
+        for k, v in req.resp_headers.items():
+            if k.lower() == 'content-type':
+                content_type = v.lower()
+        if not data:
+            return ''
+        if content_type and (not any((t in content_type for t in self.TEXT_TYPES))):
+            return data
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            if not content_type:
+                return data
+            text = data.decode('utf-8', errors='replace')
+        if 'json' in content_type or text[:1] in ('{', '['):
+            try:
+                return json.loads(text)
+            except ValueError:
+                pass
+        return text
+
+    def _run(self, req, callbacks, timeout):
+        on_success, on_failure, on_error, on_redirect = callbacks
+        self._route(req)
+        while True:
+            try:
+                data = self._send(req, timeout)
+                req.result = self._decode(req, data)
+                break
+            except Exception as e:
+                if self._failover(req, e):
+                    continue
+                req.error = e
+                break
+        if req.error is None:
+            self._observe(req)
+        req.is_finished = True
+        if req.method not in ('GET', 'HEAD'):
+            self._note_write()
+        for waiter in self._settle(req, callbacks):
+            self._deliver(req, waiter)
+
+    def _settle(self, req, callbacks):
+        if req.coalesce_key is None:
+            return [callbacks]
+        with self.lock:
+            if self.inflight.get(req.coalesce_key) is req:
+                del self.inflight[req.coalesce_key]
+                if req.error is None and req.resp_status < 300 and req.epoch == self.write_epoch:
+                    self.recent[req.coalesce_key] = (req, time.monotonic())
+            waiters = req.waiters
+            req.waiters = []
+        return waiters
+
+    def _deliver(self, req, callbacks):
+        on_success, on_failure, on_error, on_redirect = callbacks
+        if req.error is not None:
+            self._dispatch(on_error, req, req.error)
+        elif req.resp_status >= 400:
+            self._dispatch(on_failure, req, req.result)
+        elif req.resp_status >= 300:
+            self._dispatch(on_redirect, req, req.result)
+        else:
+            self._dispatch(on_success, req, req.result)
+
+    def _dispatch(self, callback, req, value):
+        if callback is not None:
+            Clock.schedule_once(lambda dt: callback(req, value), 0)
+
+class HealthMonitor:
+    CONNECTING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+    def __init__(self, port, on_result, on_connected=None, timeout=2.0, min_interval=2.0, max_interval=15.0, offline_interval=5.0):
+        self.port = port
+        self.on_result = on_result
+        self.on_connected = on_connected
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.offline_interval = offline_interval
+        self.cond = threading.Condition()
+        self.hosts = []
+        self.links = {}
+        self.best = None
+        self.interval = min_interval
+        self.paused = False
+        self.wake = False
+        self.stopped = False
+        self.thread = None
+
+    def set_hosts(self, *hosts):
+        hosts = [h for h in dict.fromkeys(hosts) if h]
+        with self.cond:
+            if hosts != self.hosts:
+                self.hosts = hosts
+                self.links = {h: self.links[h] for h in hosts if h in self.links}
+
+    def poke(self):
+        with self.cond:
+            self.paused = False
+            self.wake = True
+            self.interval = self.min_interval
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def pause(self):
+        with self.cond:
+            self.paused = True
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.wake = True
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                deadline = time.monotonic() + self.interval
+                while not self.wake:
+                    if self.paused:
+                        self.cond.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.stopped:
+                    return
+                self.wake = False
+                hosts = list(self.hosts)
+            samples = self._probe(hosts)
+            with self.cond:
+                result = self._update(hosts, samples)
+            try:
+                self.on_result(result)
+            except Exception as e:
+                print(f'Health Monitor Error: {e}')
+
+    def _probe(self, hosts):
+        samples = dict.fromkeys(hosts)
+        pending = {}
+        for host in hosts:
+            try:
+                family, kind, proto, _, addr = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, kind, proto)
+            except OSError:
+                continue
+            sock.setblocking(False)
+            if sock.connect_ex(addr) not in self.CONNECTING:
+                sock.close()
+                continue
+            pending[sock] = (host, time.monotonic())
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            socks = list(pending)
+            try:
+                _, writable, failed = select.select([], socks, socks, remaining)
+            except OSError:
+                break
+            for sock in set(writable) | set(failed):
+                host, started = pending.pop(sock)
+                if sock in failed or sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    sock.close()
+                    continue
+                samples[host] = (time.monotonic() - started) * 1000
+                self._connected(host, sock)
+        for sock in pending:
+            sock.close()
+        return samples
+
+    def _connected(self, host, sock):
+        if self.on_connected is None:
+            sock.close()
+            return
+        try:
+            self.on_connected(host, self.port, sock)
+        except Exception:
+            sock.close()
+
+    def _update(self, hosts, samples):
+        changed = False
+        for host in hosts:
+            link = self.links.setdefault(host, {'up': False, 'srtt': 0.0, 'rttvar': 0.0, 'last': 0.0, 'fails': 0, 'probes': 0})
+            sample = samples.get(host)
+            link['probes'] += 1
+            if sample is None:
+                changed = changed or link['up']
+                link['up'] = False
+                link['fails'] += 1
+                continue
+            if not link['up']:
+                changed = True
+                link['srtt'] = sample
+                link['rttvar'] = sample / 2
+            else:
+                deviation = abs(sample - link['srtt'])
+                changed = changed or deviation > max(4 * link['rttvar'], 20.0)
+                link['rttvar'] = link['rttvar'] * 0.75 + deviation * 0.25
+                link['srtt'] = link['srtt'] * 0.875 + sample * 0.125
+            link['up'] = True
+            link['fails'] = 0
+            link['last'] = sample
+        live = [h for h in hosts if self.links[h]['up']]
+        best = min(live, key=lambda h: self.links[h]['srtt']) if live else None
+        changed = changed or best != self.best
+        self.best = best
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval if best else self.offline_interval, self.interval * 1.5)
+        links = {h: {'up': self.links[h]['up'], 'rtt': int(round(self.links[h]['srtt'])), 'jitter': int(round(self.links[h]['rttvar']))} for h in hosts}
+        return {'host': best, 'links': links, 'changed': changed}
+
+    def stats(self):
+        with self.cond:
+            links = {host: {'up': link['up'], 'srtt_ms': round(link['srtt'], 1), 'jitter_ms': round(link['rttvar'], 1), 'last_ms': round(link['last'], 1), 'fails': link['fails'], 'probes': link['probes']} for host, link in self.links.items()}
+            return {'best': self.best, 'interval_s': round(self.interval, 1), 'links': links}
+
+class SearchCancelled(Exception):
+    pass
+
+class SearchJob:
+
+    def __init__(self, executor, channel, generation):
+        self.executor = executor
+        self.channel = channel
+        self.generation = generation
+
+    def check(self):
+        if not self.executor.is_current(self.channel, self.generation):
+            raise SearchCancelled()
+
+    def scan(self, items, every=512):
+        for i, item in enumerate(items):
+            if i % every == 0:
+                self.check()
+            yield item
+
+    def publish(self, fn, *args):
+        self.check()
+
+        def apply(dt):
+            if self.executor.is_current(self.channel, self.generation):
+                fn(*args)
+        Clock.schedule_once(apply, 0)
+
+class SearchExecutor:
+
+    def __init__(self, min_delay=0.1, max_delay=0.4, default_delay=0.3):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()
+        self.generations = {}
+        self.latency = {}
+        self.thread = None
+
+    def submit(self, channel, fn, *args):
+        with self.cond:
+            generation = self.generations.get(channel, 0) + 1
+            self.generations[channel] = generation
+            self.pending[channel] = (generation, fn, args)
+            self.pending.move_to_end(channel)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return generation
+
+    def cancel(self, channel):
+        with self.cond:
+            self.generations[channel] = self.generations.get(channel, 0) + 1
+            self.pending.pop(channel, None)
+
+    def is_current(self, channel, generation):
+        return self.generations.get(channel) == generation
+
+    def delay(self, channel):
+        info = self.latency.get(channel)
+        if not info or not info['done']:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, self.min_delay + info['ewma'] * 2))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                channel, (generation, fn, args) = self.pending.popitem(last=False)
+            job = SearchJob(self, channel, generation)
+            started = time.monotonic()
+            cancelled = False
+            try:
+                fn(job, *args)
+            except SearchCancelled:
+                cancelled = True
+            except Exception as e:
+                print(f'Search Error ({channel}): {e}')
+            self._record(channel, time.monotonic() - started, cancelled)
+
+    def _record(self, channel, elapsed, cancelled):
+        info = self.latency.setdefault(channel, {'done': 0, 'cancelled': 0, 'last': 0.0, 'ewma': 0.0})
+        if cancelled:
+            info['cancelled'] += 1
+            return
+        info['ewma'] = elapsed if not info['done'] else info['ewma'] * 0.8 + elapsed * 0.2
+        info['last'] = elapsed
+        info['done'] += 1
+
+    def stats(self):
+        return {channel: {'done': info['done'], 'cancelled': info['cancelled'], 'last_ms': round(info['last'] * 1000, 1), 'ewma_ms': round(info['ewma'] * 1000, 1), 'debounce_ms': round(self.delay(channel) * 1000)} for channel, info in list(self.latency.items())}
+
 class SmartTextField(MDTextField):
 
     def __init__(self, **kwargs):
@@ -192,7 +2444,7 @@ class ProductRecycleItem(RecycleDataViewBehavior, MDBoxLayout):
     icon_name = StringProperty('package-variant')
     icon_color = ListProperty([0, 0, 0, 1])
     price_color = ListProperty([0, 0, 0, 1])
-    product_data = ObjectProperty(None)
+    product_id = StringProperty('')
 
     def refresh_view_attrs(self, rv, index, data):
         self.index = index
@@ -202,13 +2454,14 @@ class ProductRecycleItem(RecycleDataViewBehavior, MDBoxLayout):
         self.icon_name = data.get('icon', 'package-variant')
         self.icon_color = data.get('icon_color', [0, 0, 0, 1])
         self.price_color = data.get('price_color', [0, 0, 0, 1])
-        self.product_data = data.get('raw_data')
+        self.product_id = data.get('product_id', '')
         return super().refresh_view_attrs(rv, index, data)
 
     def on_tap(self):
         app = MDApp.get_running_app()
-        if self.product_data:
-            app.open_add_to_cart_dialog(self.product_data, app.current_mode)
+        product = app.row_cache.product(self.product_id) if self.product_id else None
+        if product:
+            app.open_add_to_cart_dialog(product, app.current_mode)
 
 class HistoryRecycleItem(RecycleDataViewBehavior, MDCard):
     index = None
@@ -334,6 +2587,16 @@ class HistoryRecycleView(RecycleView):
         super(HistoryRecycleView, self).__init__(**kwargs)
         self.data = []
 
+class EntityHistoryRecycleView(HistoryRecycleView):
+
+    def on_scroll_y(self, instance, value):
+        layout = self.layout_manager
+        remaining = value * max(0, layout.height - self.height) if layout is not None else 0
+        if value <= 0.05 or remaining < self.height:
+            app = MDApp.get_running_app()
+            if app and hasattr(app, 'load_more_entity_history'):
+                app.load_more_entity_history()
+
 class MgmtEntityRecycleView(RecycleView):
 
     def __init__(self, **kwargs):
@@ -353,7 +2616,9 @@ class ProductRecycleView(RecycleView):
         self.data = []
 
     def on_scroll_y(self, instance, value):
-        if value <= 0.05:
+        layout = self.layout_manager
+        remaining = value * max(0, layout.height - self.height) if layout is not None else 0
+        if value <= 0.05 or remaining < self.height:
             app = MDApp.get_running_app()
             if app and hasattr(app, 'load_more_products'):
                 app.load_more_products()
@@ -361,12 +2626,42 @@ class ProductRecycleView(RecycleView):
 class StockApp(MDApp):
     cart = []
     all_products_raw = []
+    product_table = None
+    product_index = None
+    barcode_index = None
+    catalogue_version = ''
+    batch_sync_supported = True
+    entity_history_supported = True
+    entity_history_view = None
+    history_target_kind = 'clients'
+    history_cache = None
+    sync_scheduler = None
+    api = None
+    display_cache = None
+    row_cache = None
+    search_executor = None
+    query_cache = None
+    gzip_upload = False
+    _sync_wakeup_event = None
+    catalogue_writer = None
+    _index_generation = 0
+    _products_fetch_active = False
+    _products_fetch_stamp = None
+    _products_fetch_epoch = 0
+    _products_refetch = False
     all_clients = []
     all_suppliers = []
-    last_ping = 0
+    entity_index = None
+    balance_journal = None
+    _balance_flush_event = None
+    ping_rtt = 0
+    ping_jitter = 0
+    health_monitor = None
+    endpoints = None
     current_mode = 'sale'
     local_server_ip = '192.168.1.100'
     external_server_ip = ''
+    alt_server_ips = []
     active_server_ip = '192.168.1.100'
     current_user_name = 'ADMIN'
     is_server_reachable = False
@@ -380,6 +2675,7 @@ class StockApp(MDApp):
     editing_payment_amount = None
     offline_store = None
     cache_store = None
+    catalogue_store = None
     store = None
     stats_store = None
     dialog = None
@@ -387,7 +2683,6 @@ class StockApp(MDApp):
     status_bar_bg = None
     rv_products = None
     _notify_event = None
-    _heartbeat_event = None
     _ready_timer = None
     entity_list_layout = None
     history_list_layout = None
@@ -407,239 +2702,122 @@ class StockApp(MDApp):
     lbl_total_title = None
     current_entity_type_mgmt = 'account'
     DOC_TRANSLATIONS = {'BV': 'Bon de Vente', 'BA': "Bon d'Achat", 'FC': 'Facture Vente', 'FF': 'Facture Achat', 'RC': 'Retour Client', 'RF': 'Retour Fournisseur', 'TR': 'Transfert de Stock', 'FP': 'Facture Proforma', 'DP': 'Bon de Commande', 'BI': 'Bon Initial'}
-    current_product_list_source = []
-    current_page_offset = 0
+    product_cursor = None
     batch_size = 50
     is_loading_more = False
 
     def fix_text(self, text):
         if not text:
             return ''
+        return self.display_cache.get(str(text))
+
+    @staticmethod
+    def shape_text(text):
         try:
-            text = str(text)
             reshaped_text = reshaper.reshape(text)
             bidi_text = get_display(reshaped_text)
             return bidi_text
         except:
-            return str(text)
+            return text
+
+    def pin_display_names(self, group, items):
+        names = [str(x.get('name', '')) for x in items]
+        threading.Thread(target=self._pin_display_worker, args=(group, names), daemon=True).start()
+
+    def _pin_display_worker(self, group, names):
+        try:
+            self.display_cache.pin(group, names)
+        except Exception as e:
+            print(f'Display Cache Error: {e}')
 
     def prepare_products_for_rv(self, products_list):
-        self.current_product_list_source = products_list
-        self.current_page_offset = 0
-        self.is_loading_more = False
+        self.show_product_cursor(ProductResultCursor('list', products_list, self.batch_size))
+
+    def browse_products(self):
+        if not self.all_products_raw and self.has_local_catalogue():
+            return ProductResultCursor('catalogue', self.catalogue_store, self.batch_size)
+        return ProductResultCursor('list', self.all_products_raw, self.batch_size)
+
+    def show_product_cursor(self, cursor):
+        self.product_cursor = cursor
+        self.is_loading_more = True
         if self.rv_products:
             if not self.rv_products.data:
                 self.rv_products.refresh_from_data()
-        self.load_more_products(reset=True)
+        self.search_executor.submit('product_pages', self._product_page_worker, cursor, True)
 
-    def load_more_products(self, reset=False):
-        if self.is_loading_more and (not reset):
-            return
-        total_items = len(self.current_product_list_source)
-        if self.current_page_offset >= total_items and (not reset):
+    def load_more_products(self):
+        cursor = self.product_cursor
+        if cursor is None or cursor.exhausted or self.is_loading_more:
             return
         self.is_loading_more = True
-        if reset:
-            self.current_page_offset = 0
-        start = self.current_page_offset
-        end = start + self.batch_size
-        if end > total_items:
-            end = total_items
-        batch_to_load = self.current_product_list_source[start:end]
-        threading.Thread(target=self._process_batch_data, args=(batch_to_load, reset), daemon=True).start()
-
-    def _process_batch_data(self, batch, reset=False):
-        rv_data = []
-        is_sale = self.current_mode in ['sale', 'return_sale', 'invoice_sale', 'proforma']
-        is_transfer = self.current_mode == 'transfer'
-        allowed_autre_modes = ['sale', 'invoice_sale', 'proforma', 'order_purchase']
+        self.search_executor.submit('product_pages', self._product_page_worker, cursor, False)
 
-        def fmt_qty(val):
-            try:
-                val = float(val)
-                if val.is_integer():
-                    return str(int(val))
-                return str(val)
-            except:
-                return '0'
-        try:
-            for p in batch:
-                prod_name_lower = str(p.get('name', '')).lower()
-                if prod_name_lower.startswith('autre article'):
-                    if self.current_mode not in allowed_autre_modes:
-                        continue
-                s_store = float(p.get('stock', 0) or 0)
-                s_wh = float(p.get('stock_warehouse', 0) or 0)
-                total_stock = s_store + s_wh
-                if is_transfer and total_stock < -900000:
-                    continue
-                price_fmt = ''
-                price_color = [0, 0, 0, 1]
-                stock_text = ''
-                has_promo = p.get('has_promo', False)
-                if is_transfer:
-                    price_fmt = f'Qnt Tot: {fmt_qty(total_stock)}'
-                    price_color = [0.2, 0.2, 0.8, 1]
-                    stock_text = f'Mag: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
-                else:
-                    if is_sale:
-                        price = float(p.get('price', 0) or 0)
-                        price_fmt = f'{price:.2f} DA'
-                        if has_promo:
-                            price_color = [0.5, 0, 0.5, 1]
-                            price_fmt = f'PROMO: {price:.2f} DA'
-                        else:
-                            price_color = [0, 0.6, 0, 1]
-                    else:
-                        p_price = p.get('purchase_price', 0)
-                        if p_price is None:
-                            p_price = p.get('price', 0)
-                        price = float(p_price or 0)
-                        price_fmt = f'{price:.2f} DA'
-                        price_color = [0.9, 0.5, 0, 1]
-                    if total_stock < -900000:
-                        stock_text = 'Illimité'
-                    elif s_wh == 0:
-                        stock_text = f'Qté: {fmt_qty(s_store)}'
-                    else:
-                        stock_text = f'Qté: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
-                icon = 'package-variant' if total_stock > 0 or total_stock < -900000 else 'package-variant-closed'
-                if has_promo and is_sale:
-                    icon = 'sale'
-                icon_col = [0, 0.6, 0, 1] if total_stock > 0 or total_stock < -900000 else [0.8, 0, 0, 1]
-                raw_name = str(p.get('name', 'Inconnu'))
-                display_name = self.fix_text(raw_name)
-                rv_data.append({'name': display_name, 'price_text': price_fmt, 'stock_text': stock_text, 'icon': icon, 'icon_color': icon_col, 'price_color': price_color, 'raw_data': p})
-        except Exception as e:
-            print(f'Batch Process Error: {e}')
-        self._append_to_rv(rv_data, reset)
+    def _product_page_worker(self, job, cursor, reset):
+        page = cursor.next_page()
+        job.publish(self._show_product_page, cursor, self.product_rows(page), reset)
 
-    @mainthread
-    def _append_to_rv(self, new_data, reset=False):
+    def _show_product_page(self, cursor, rv_data, reset):
+        if reset:
+            self.search_executor.cancel('product_pages')
+            self.product_cursor = cursor
+        elif cursor is not self.product_cursor:
+            return
+        self.is_loading_more = False
         if self.rv_products:
             if reset:
-                self.rv_products.data = new_data
-                self.current_page_offset = len(new_data)
+                self.rv_products.data = rv_data
             else:
-                self.rv_products.data.extend(new_data)
-                self.current_page_offset += len(new_data)
+                self.rv_products.data.extend(rv_data)
             self.rv_products.refresh_from_data()
-        self.is_loading_more = False
+            if not cursor.exhausted and len(self.rv_products.data) < self.batch_size:
+                self.load_more_products()
+
+    def product_rows(self, products):
+        try:
+            self.row_cache.sync(self.catalogue_version)
+            return self.row_cache.rows(products, self.current_mode)
+        except Exception as e:
+            print(f'Data Prep Error: {e}')
+            return []
 
     def filter_products(self, instance, text):
         query = instance.get_value() if hasattr(instance, 'get_value') else text
         if self._search_event:
             self._search_event.cancel()
-        self._search_event = Clock.schedule_once(lambda dt: self._start_background_search(query), 0.3)
+        self._search_event = Clock.schedule_once(lambda dt: self._start_background_search(query), self.search_executor.delay('products'))
 
     def _start_background_search(self, query):
-        threading.Thread(target=self._search_worker, args=(query,), daemon=True).start()
-
-    def _search_worker(self, query):
-        if not query:
-            self._prepare_and_send_data(self.all_products_raw[:50])
-            return
-        query_clean = query.lower().strip()
-        tokens = query_clean.split()
-        filtered = []
-        for p in self.all_products_raw:
-            p_name = str(p.get('name', '')).lower()
-            is_match_name = True
-            for token in tokens:
-                if token not in p_name:
-                    is_match_name = False
-                    break
-            p_bar = str(p.get('barcode', '')).lower()
-            p_ref = str(p.get('product_ref', '')).lower()
-            if is_match_name or query_clean in p_bar or query_clean in p_ref:
-                filtered.append(p)
-        if len(filtered) > 50:
-            filtered = filtered[:50]
-        self._prepare_and_send_data(filtered)
-
-    def _prepare_and_send_data(self, products_list):
-        rv_data = []
-        is_sale = self.current_mode in ['sale', 'return_sale', 'invoice_sale', 'proforma']
-        is_transfer = self.current_mode == 'transfer'
-        allowed_autre_modes = ['sale', 'invoice_sale', 'proforma', 'order_purchase']
-
-        def fmt_qty(val):
-            try:
-                val = float(val)
-                if val.is_integer():
-                    return str(int(val))
-                return str(val)
-            except:
-                return '0'
-        try:
-            for p in products_list:
-                prod_name_lower = str(p.get('name', '')).lower()
-                if prod_name_lower.startswith('autre article'):
-                    if self.current_mode not in allowed_autre_modes:
-                        continue
-                s_store = float(p.get('stock', 0) or 0)
-                s_wh = float(p.get('stock_warehouse', 0) or 0)
-                total_stock = s_store + s_wh
-                if is_transfer and total_stock < -900000:
-                    continue
-                price_fmt = ''
-                price_color = [0, 0, 0, 1]
-                stock_text = ''
-                if is_transfer:
-                    price_fmt = f'Qnt Tot: {fmt_qty(total_stock)}'
-                    price_color = [0.2, 0.2, 0.8, 1]
-                    stock_text = f'Mag: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
-                else:
-                    if is_sale:
-                        price = float(p.get('price', 0) or 0)
-                        price_fmt = f'{price:.2f} DA'
-                        price_color = [0, 0.6, 0, 1]
-                    else:
-                        p_price = p.get('purchase_price', 0)
-                        if p_price is None:
-                            p_price = p.get('price', 0)
-                        price = float(p_price or 0)
-                        price_fmt = f'{price:.2f} DA'
-                        price_color = [0.9, 0.5, 0, 1]
-                    if total_stock < -900000:
-                        stock_text = 'Illimité'
-                    elif s_wh == 0:
-                        stock_text = f'Qté: {fmt_qty(s_store)}'
-                    else:
-                        stock_text = f'Qté: {fmt_qty(s_store)} | Dép: {fmt_qty(s_wh)}'
-                icon = 'package-variant' if total_stock > 0 or total_stock < -900000 else 'package-variant-closed'
-                icon_col = [0, 0.6, 0, 1] if total_stock > 0 or total_stock < -900000 else [0.8, 0, 0, 1]
-                raw_name = str(p.get('name', 'Inconnu'))
-                display_name = self.fix_text(raw_name)
-                rv_data.append({'name': display_name, 'price_text': price_fmt, 'stock_text': stock_text, 'icon': icon, 'icon_color': icon_col, 'price_color': price_color, 'raw_data': p})
-        except Exception as e:
-            print(f'Data Prep Error: {e}')
-        self._apply_search_results(rv_data)
-
-    def play_sound(self, type_):
-        if platform == 'android' and hasattr(self, 'tone_gen') and self.tone_gen:
-            try:
-                if type_ == 'success':
-                    self.tone_gen.startTone(24, 150)
-                elif type_ == 'error':
-                    self.tone_gen.startTone(97, 300)
-                elif type_ == 'duplicate':
-                    self.tone_gen.startTone(29, 150)
-            except:
-                pass
-
-    def play_beep(self):
-        if platform == 'android' and hasattr(self, 'tone_gen') and self.tone_gen:
-            try:
-                self.tone_gen.startTone(24, 150)
-            except:
-                pass
-
-    @mainthread
-    def _apply_search_results(self, rv_data):
-        if self.rv_products:
-            self.rv_products.data = rv_data
-            self.rv_products.refresh_from_data()
+        self.search_executor.submit('products', self._search_worker, query)
+
+    def _search_worker(self, job, query):
+        query_clean = SearchText.normalize(query).strip()
+        cursor = self._search_products(job, query_clean) if query_clean else self.browse_products()
+        page = cursor.next_page()
+        job.publish(self._show_product_page, cursor, self.product_rows(page), True)
+
+    def _search_products(self, job, query_clean):
+        index = self.product_index
+        indexed = index is not None and index.source is self.all_products_raw
+        if not indexed and (not self.all_products_raw) and self.has_local_catalogue():
+            return ProductResultCursor('catalogue_search', self.catalogue_store, self.batch_size, query_clean)
+        cache = self.query_cache
+        cache.bind((id(self.all_products_raw), self._index_generation, self.catalogue_version))
+        matches = cache.get(query_clean)
+        if matches is None:
+            tokens = query_clean.split()
+            candidates = cache.base(query_clean)
+            if candidates is not None:
+                matches = [p for p in job.scan(candidates) if ProductSearchIndex.matches(p, query_clean, tokens)]
+            elif indexed:
+                matches = index.search(query_clean, limit=None)
+            else:
+                matches = [p for p in job.scan(self.all_products_raw) if ProductSearchIndex.matches(p, query_clean, tokens)]
+            job.check()
+            cache.put(query_clean, matches)
+        if not matches and indexed:
+            matches = index.search(query_clean, limit=None, fuzzy=True)
+        return ProductResultCursor('ranked', matches, self.batch_size, query_clean)
 
     def open_bluetooth_selector(self, instance):
         if platform != 'android':
@@ -926,9 +3104,7 @@ class StockApp(MDApp):
             entity_name_raw = transaction_data.get('entity')
         if not entity_name_raw and transaction_data.get('entity_id'):
             ent_id = transaction_data.get('entity_id')
-            found = next((c for c in self.all_clients if str(c['id']) == str(ent_id)), None)
-            if not found:
-                found = next((s for s in self.all_suppliers if str(s['id']) == str(ent_id)), None)
+            found = self.entity_index.get(ent_id)
             if found:
                 entity_name_raw = found.get('name')
         if not entity_name_raw:
@@ -1093,6 +3269,16 @@ class StockApp(MDApp):
         self.title = 'MagPro Gestion de Stock'
         self._search_event = None
         self._entity_search_event = None
+        self.sync_scheduler = SyncScheduler(max_in_flight=SYNC_MAX_IN_FLIGHT, park_after=SYNC_PARK_AFTER)
+        self.endpoints = EndpointManager()
+        self.api = ApiClient(endpoints=self.endpoints)
+        self.health_monitor = HealthMonitor(int(DEFAULT_PORT), self._finalize_ping_ui, on_connected=self.api.adopt)
+        self.display_cache = DisplayTextCache(self.shape_text)
+        self.row_cache = ProductRowCache(self.fix_text)
+        self.entity_index = EntityIndex()
+        self._dirty_entity_kinds = set()
+        self.search_executor = SearchExecutor()
+        self.query_cache = QueryResultCache()
         self.theme_cls.primary_palette = 'Blue'
         self.theme_cls.accent_palette = 'Amber'
         self.theme_cls.theme_style = 'Light'
@@ -1105,20 +3291,33 @@ class StockApp(MDApp):
         self.theme_cls.font_styles['Body2'] = ['ArabicFont', 14, False, 0.25]
         self.theme_cls.font_styles['Button'] = ['ArabicFont', 14, True, 1.25]
         self.theme_cls.font_styles['Caption'] = ['ArabicFont', 12, False, 0.4]
+        self.data_dir = self.user_data_dir
+        self.catalogue_writer = ThreadPoolExecutor(max_workers=1)
         try:
-            self.data_dir = self.user_data_dir
-            self.offline_store = JsonStore(os.path.join(self.data_dir, 'stock_pending_orders.json'))
-            self.cache_store = JsonStore(os.path.join(self.data_dir, 'stock_cache.json'))
-            self.stats_store = JsonStore(os.path.join(self.data_dir, 'local_stats.json'))
             self.store = JsonStore(os.path.join(self.data_dir, 'app_settings.json'))
             if self.store.exists('config'):
                 conf = self.store.get('config')
                 self.local_server_ip = conf.get('ip', '192.168.1.100')
                 self.external_server_ip = conf.get('ext_ip', '')
+                self.alt_server_ips = list(conf.get('alt_ips', []) or [])
                 self.is_seller_mode = conf.get('seller_mode', False)
+                self.gzip_upload = conf.get('gzip_upload', False)
                 self.active_server_ip = self.local_server_ip
+            self.api.gzip_upload = self.gzip_upload
         except Exception as e:
             print(f'Storage Init Error: {e}')
+        self.stats_store = self._open_store(JsonStore, 'local_stats.json')
+        try:
+            if self.stats_store and self.stats_store.exists('network'):
+                self.api.load_stats(self.stats_store.get('network').get('endpoints', {}))
+        except Exception as e:
+            print(f'Runtime Stats Error: {e}')
+        legacy_orders = os.path.join(self.data_dir, 'stock_pending_orders.json')
+        self.offline_store = self._open_store(lambda path: OfflineJournal(path, legacy_path=legacy_orders), 'stock_pending_orders.jsonl', rebuildable=False)
+        self.cache_store = self._open_store(JsonStore, 'stock_cache.json')
+        self.balance_journal = self._open_store(BalanceJournal, 'stock_balances.jsonl', rebuildable=False)
+        self.catalogue_store = self._open_store(CatalogueStore, 'stock_catalogue.db')
+        self.history_cache = self._open_store(EntityHistoryCache, 'stock_history.db')
         self.root_box = MDBoxLayout(orientation='vertical')
         self.sm = MDScreenManager()
         self.sm.add_widget(self._build_login_screen())
@@ -1130,9 +3329,59 @@ class StockApp(MDApp):
         self.status_bar_label = MDLabel(text='Initialisation...', halign='center', theme_text_color='Custom', text_color=(1, 1, 1, 1), font_style='Caption', bold=True)
         self.status_bar_bg.add_widget(self.status_bar_label)
         self.root_box.add_widget(self.status_bar_bg)
-        self._heartbeat_event = Clock.schedule_interval(self.check_server_heartbeat, 5)
+        self.check_server_heartbeat(0)
         return self.root_box
 
+    def _open_store(self, factory, name, rebuildable=True):
+        path = os.path.join(self.data_dir, name)
+        try:
+            return factory(path)
+        except Exception as e:
+            print(f'Storage Init Error ({name}): {e}')
+        if not rebuildable:
+            Clock.schedule_once(lambda dt: self.notify(f'Fichier local illisible: {name}', 'error'), 1)
+            return None
+        try:
+            stamp = int(time.time())
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.replace(path + suffix, f'{path}.broken-{stamp}{suffix}')
+            return factory(path)
+        except Exception as e:
+            print(f'Storage Reset Error ({name}): {e}')
+            return None
+
+    def save_runtime_stats(self):
+        try:
+            if self.api and self.stats_store:
+                self.stats_store.put('network', endpoints=self.api.stats_snapshot(), coalesced=self.api.coalesced, updated=time.time())
+            if self.display_cache and self.stats_store:
+                self.stats_store.put('display_cache', **self.display_cache.stats())
+            if self.search_executor and self.stats_store:
+                self.stats_store.put('search', channels=self.search_executor.stats(), results=self.query_cache.stats(), updated=time.time())
+            if self.health_monitor and self.stats_store:
+                self.stats_store.put('health', routing=self.endpoints.stats(), **self.health_monitor.stats())
+        except Exception as e:
+            print(f'Runtime Stats Error: {e}')
+
+    def on_pause(self):
+        self.save_runtime_stats()
+        self.flush_entity_balances()
+        if self.health_monitor:
+            self.health_monitor.pause()
+        return True
+
+    def on_resume(self):
+        self.check_server_heartbeat(0)
+
+    def on_stop(self):
+        self.save_runtime_stats()
+        if self.health_monitor:
+            self.health_monitor.stop()
+        self.flush_entity_balances()
+        if self.balance_journal:
+            self.balance_journal.close()
+
     def get_device_id(self):
         import platform
         if platform.system() == 'Windows':
@@ -1318,6 +3567,7 @@ class StockApp(MDApp):
                         self.offline_store.delete(key)
                         count += 1
             if count > 0:
+                self.offline_store.compact()
                 print(f'Cleaned {count} old synced items.')
         except Exception as e:
             print(f'Cleanup Error: {e}')
@@ -1380,33 +3630,72 @@ class StockApp(MDApp):
         self.stat_net_total = self.stat_sales_today + self.stat_client_payments - (self.stat_purchases_today + self.stat_supplier_payments)
         self.update_dashboard_labels()
 
-    def update_local_entity_balance(self, entity_id, change_amount):
+    def entity_kind(self, data):
+        if data.get('type') in ('client_pay', 'supplier_pay'):
+            return 'suppliers' if data['type'] == 'supplier_pay' else 'clients'
+        if data.get('doc_type'):
+            return 'suppliers' if data['doc_type'] in ['BA', 'FF', 'RF', 'DP', 'BI'] else 'clients'
+        return self.entity_index.kind_of(data.get('entity_id'))
+
+    def update_local_entity_balance(self, entity_id, change_amount, kind=None):
         if not entity_id:
             return
-        target_entity = None
-        is_client = False
-        for c in self.all_clients:
-            if c['id'] == entity_id:
-                target_entity = c
-                is_client = True
-                break
-        if not target_entity:
-            for s in self.all_suppliers:
-                if s['id'] == entity_id:
-                    target_entity = s
-                    is_client = False
-                    break
+        key = kind or self.entity_index.kind_of(entity_id)
+        target_entity = self.entity_index.get(entity_id, key) if key else None
+        if key and self.history_cache:
+            self._queue_catalogue_write(self.history_cache.invalidate, key, entity_id)
         if target_entity:
             try:
                 current_bal = float(target_entity.get('balance', 0))
                 new_bal = current_bal + float(change_amount)
                 target_entity['balance'] = new_bal
-                key = 'clients' if is_client else 'suppliers'
-                data_list = self.all_clients if is_client else self.all_suppliers
-                self.cache_store.put(key, data=data_list)
+                if self.balance_journal:
+                    self.balance_journal.record(key, entity_id, float(change_amount))
+                    self._schedule_balance_flush(key)
+                else:
+                    self._persist_entities(key)
             except Exception as e:
                 pass
 
+    def _schedule_balance_flush(self, key):
+        self._dirty_entity_kinds.add(key)
+        if self._balance_flush_event is None:
+            self._balance_flush_event = Clock.schedule_once(lambda dt: self.flush_entity_balances(), 30)
+
+    def flush_entity_balances(self):
+        if self._balance_flush_event is not None:
+            self._balance_flush_event.cancel()
+            self._balance_flush_event = None
+        for key in list(self._dirty_entity_kinds):
+            self._persist_entities(key)
+
+    def _persist_entities(self, key):
+        try:
+            seq = self.balance_journal.last_seq() if self.balance_journal else 0
+            data = self.all_clients if key == 'clients' else self.all_suppliers
+            self.cache_store.put(key, data=copy.deepcopy(data), balance_seq=seq)
+            self._dirty_entity_kinds.discard(key)
+            if self.balance_journal:
+                self.balance_journal.truncate(key, seq)
+        except Exception as e:
+            print(f'Balance Cache Error: {e}')
+
+    def _load_cached_entities(self, key):
+        record = self.cache_store.get(key)
+        self._set_entities(key, copy.deepcopy(record['data']))
+        if self.balance_journal:
+            replayed = False
+            for entity_id, delta in self.balance_journal.pending(key, record.get('balance_seq', 0)):
+                entity = self.entity_index.get(entity_id, key)
+                if entity is not None:
+                    try:
+                        entity['balance'] = float(entity.get('balance', 0)) + delta
+                        replayed = True
+                    except (TypeError, ValueError):
+                        pass
+            if replayed:
+                self._persist_entities(key)
+
     def filter_entity_history_list(self, day_offset=None, specific_date=None):
         if not hasattr(self, 'rv_entity_history'):
             return
@@ -1426,93 +3715,148 @@ class StockApp(MDApp):
             self.btn_ent_hist_yesterday.md_bg_color = active_color if day_offset == 1 else inactive_color
             self.btn_ent_hist_date.md_bg_color = inactive_color
             self.btn_ent_hist_date.text = 'CALENDRIER'
-        self.rv_entity_history.data = [{'raw_text': 'Chargement...', 'raw_sec': '', 'amount_text': '', 'icon': 'timer-sand', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
+        entity = self.history_target_entity
+        view = {'kind': self.history_target_kind, 'entity_id': str(entity.get('id')), 'name': str(entity.get('name', '')), 'day': str(target_date), 'items': [], 'next': None, 'loading': False}
+        self.entity_history_view = view
+        cached = self.history_cache.get(view['kind'], view['entity_id'], view['day']) if self.history_cache else None
+        if cached:
+            view['items'] = cached['items']
+            view['next'] = cached['next']
+            self._render_entity_history(view)
+            if self.is_server_reachable and time.time() - cached['fetched'] > ENTITY_HISTORY_TTL:
+                self._fetch_entity_history_page(view, 0, max(ENTITY_HISTORY_PAGE, len(view['items'])))
+        elif self.is_server_reachable:
+            self.rv_entity_history.data = [{'raw_text': 'Chargement...', 'raw_sec': '', 'amount_text': '', 'icon': 'timer-sand', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
+            self._fetch_entity_history_page(view, 0, ENTITY_HISTORY_PAGE)
+        else:
+            self.rv_entity_history.data = [{'raw_text': 'Mode Hors Ligne', 'raw_sec': "Impossible de voir l'historique", 'amount_text': '', 'icon': 'wifi-off', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
+
+    def _fetch_entity_history_page(self, view, offset, limit):
+        paged = self.entity_history_supported
+        view['loading'] = True
 
         def on_history_fetched(req, result):
-            rv_data = []
-            if not result:
-                rv_data.append({'raw_text': 'Aucune opération trouvée.', 'raw_sec': '', 'amount_text': '', 'icon': 'information-outline', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None})
-                self.rv_entity_history.data = rv_data
+            if view is not self.entity_history_view:
                 return
-            target_name = self.history_target_entity['name'].lower()
-            main_doc_prefixes = ['BV', 'BA', 'FC', 'FF', 'RC', 'RF', 'FP', 'DP', 'BI', 'TR']
-            manual_keywords = ['versement', 'règlement', 'reglement', 'crédit', 'credit', 'dette', 'سداد', 'دفعة', 'إيداع', 'rendu', 'versé', 'excédent', 'excedent', 'فائض']
-            for item in result:
-                server_entity_name = str(item.get('entity', '')).lower()
-                if target_name not in server_entity_name:
-                    continue
-                desc = item.get('desc', '')
-                desc_lower = desc.lower()
-                prefix = desc[:2].upper() if len(desc) >= 2 else ''
-                amount = float(item.get('amount', 0))
-                time_str = item.get('time', '')
-                is_main_doc = prefix in main_doc_prefixes
-                if 'دفعة من' in desc or 'Payment from' in desc:
-                    is_excess = 'excédent' in desc_lower or 'excedent' in desc_lower or 'فائض' in desc_lower
-                    if not is_excess:
-                        continue
-                if not is_main_doc:
-                    is_manual_or_excess = any((k in desc_lower for k in manual_keywords))
-                    if not is_manual_or_excess:
-                        continue
-                icon = 'file-document'
-                color = (0.2, 0.2, 0.2, 1)
-                amount_text = f'{abs(amount):.2f} DA'
-                bg_color = (0.98, 0.98, 0.98, 1)
-                final_desc = desc
-                if not is_main_doc:
-                    if amount < 0:
-                        is_supplier_pay = 'règlement' in desc_lower or 'reglement' in desc_lower or 'supplier' in desc_lower or ('سداد' in desc_lower)
-                        if is_supplier_pay:
-                            icon = 'cash-refund'
-                            color = (1, 0.6, 0, 1)
-                            amount_text = f'+ {abs(amount):.2f} DA'
-                            user_name = item.get('user', '')
-                            final_desc = f'Règlement ({user_name})'
-                        else:
-                            icon = 'cash-plus'
-                            color = (0, 0.7, 0, 1)
-                            amount_text = f'+ {abs(amount):.2f} DA'
-                            if 'excédent' in desc_lower or 'excedent' in desc_lower:
-                                final_desc = f'Versement (Excédent)'
-                            elif 'versement' in desc_lower:
-                                final_desc = desc
-                            else:
-                                final_desc = f'Versement ({desc})'
-                    else:
-                        icon = 'notebook-edit'
-                        color = (0.8, 0, 0, 1)
-                        amount_text = f'- {abs(amount):.2f} DA'
-                        if 'crédit' in desc.lower() or 'dette' in desc.lower():
-                            final_desc = desc
-                        else:
-                            final_desc = f'Crédit ({desc})'
-                elif prefix == 'BV':
-                    icon = 'cart'
-                    color = (0, 0.5, 0.8, 1)
-                elif prefix == 'BA':
-                    icon = 'truck'
-                    color = (1, 0.6, 0, 1)
-                elif prefix == 'FC':
-                    icon = 'file-document'
-                    color = (0, 0, 0.8, 1)
-                elif prefix == 'RC':
-                    icon = 'keyboard-return'
-                    color = (0.8, 0, 0, 1)
-                final_sec = f"{time_str} • {item.get('user', '')}"
-                rv_data.append({'raw_text': final_desc, 'raw_sec': final_sec, 'amount_text': amount_text, 'icon': icon, 'icon_color': color, 'bg_color': bg_color, 'is_local': False, 'raw_data': item, 'key': ''})
-            if not rv_data:
-                rv_data.append({'raw_text': 'Aucune transaction (filtrée).', 'raw_sec': '', 'amount_text': '', 'icon': 'filter-outline', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None})
-            self.rv_entity_history.data = rv_data
-            self.rv_entity_history.refresh_from_data()
+            view['loading'] = False
+            if not paged:
+                name = view['name'].lower()
+                items = [item for item in result or [] if name in str(item.get('entity', '')).lower()] if isinstance(result, list) else []
+                next_offset = None
+            elif isinstance(result, dict):
+                items = result.get('items') or []
+                next_offset = result.get('next_offset')
+            else:
+                items = result if isinstance(result, list) else []
+                next_offset = offset + len(items) if len(items) >= limit else None
+            view['items'] = items if offset == 0 else view['items'] + items
+            view['next'] = next_offset
+            if self.history_cache:
+                self._queue_catalogue_write(self.history_cache.put, view['kind'], view['entity_id'], view['day'], list(view['items']), next_offset)
+            self._render_entity_history(view)
 
         def on_fail(req, err):
-            self.rv_entity_history.data = [{'raw_text': 'Erreur de connexion serveur.', 'raw_sec': str(err), 'amount_text': '', 'icon': 'wifi-off', 'icon_color': [0.8, 0, 0, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
-        if self.is_server_reachable:
-            url = f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/history?date={target_date}'
-            UrlRequest(url, on_success=on_history_fetched, on_failure=on_fail, on_error=on_fail)
+            if view is not self.entity_history_view:
+                return
+            view['loading'] = False
+            if paged and req.resp_status in (404, 405):
+                self.entity_history_supported = False
+                self._fetch_entity_history_page(view, 0, limit)
+            elif view['items']:
+                self.notify('Historique: erreur serveur', 'error')
+            else:
+                self.rv_entity_history.data = [{'raw_text': 'Erreur de connexion serveur.', 'raw_sec': str(err), 'amount_text': '', 'icon': 'wifi-off', 'icon_color': [0.8, 0, 0, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
+        if paged:
+            entity_type = 'supplier' if view['kind'] == 'suppliers' else 'account'
+            url = f"http://{self.active_server_ip}:{DEFAULT_PORT}/api/entity_history?type={entity_type}&entity_id={quote(view['entity_id'])}&from={view['day']}&to={view['day']}&offset={offset}&limit={limit}"
         else:
-            self.rv_entity_history.data = [{'raw_text': 'Mode Hors Ligne', 'raw_sec': "Impossible de voir l'historique", 'amount_text': '', 'icon': 'wifi-off', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None}]
+            url = f"http://{self.active_server_ip}:{DEFAULT_PORT}/api/history?date={view['day']}"
+        self.api.request(url, on_success=on_history_fetched, on_failure=on_fail, on_error=on_fail, coalesce=True)
+
+    def load_more_entity_history(self):
+        view = self.entity_history_view
+        if view is None or view['loading'] or view['next'] is None or (not self.is_server_reachable):
+            return
+        self._fetch_entity_history_page(view, view['next'], ENTITY_HISTORY_PAGE)
+
+    def _render_entity_history(self, view):
+        rv_data = []
+        for item in view['items']:
+            row = self._entity_history_row(item)
+            if row is not None:
+                rv_data.append(row)
+        if not view['items']:
+            rv_data.append({'raw_text': 'Aucune opération trouvée.', 'raw_sec': '', 'amount_text': '', 'icon': 'information-outline', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None})
+        elif not rv_data and view['next'] is None:
+            rv_data.append({'raw_text': 'Aucune transaction (filtrée).', 'raw_sec': '', 'amount_text': '', 'icon': 'filter-outline', 'icon_color': [0.5, 0.5, 0.5, 1], 'bg_color': [1, 1, 1, 1], 'is_local': False, 'raw_data': None})
+        self.rv_entity_history.data = rv_data
+        self.rv_entity_history.refresh_from_data()
+        if view['next'] is not None and len(rv_data) < ENTITY_HISTORY_PAGE // 2:
+            self.load_more_entity_history()
+
+    def _entity_history_row(self, item):
+        main_doc_prefixes = ['BV', 'BA', 'FC', 'FF', 'RC', 'RF', 'FP', 'DP', 'BI', 'TR']
+        manual_keywords = ['versement', 'règlement', 'reglement', 'crédit', 'credit', 'dette', 'سداد', 'دفعة', 'إيداع', 'rendu', 'versé', 'excédent', 'excedent', 'فائض']
+        desc = item.get('desc', '')
+        desc_lower = desc.lower()
+        prefix = desc[:2].upper() if len(desc) >= 2 else ''
+        amount = float(item.get('amount', 0))
+        time_str = item.get('time', '')
+        is_main_doc = prefix in main_doc_prefixes
+        if 'دفعة من' in desc or 'Payment from' in desc:
+            is_excess = 'excédent' in desc_lower or 'excedent' in desc_lower or 'فائض' in desc_lower
+            if not is_excess:
+                return None
+        if not is_main_doc:
+            is_manual_or_excess = any((k in desc_lower for k in manual_keywords))
+            if not is_manual_or_excess:
+                return None
+        icon = 'file-document'
+        color = (0.2, 0.2, 0.2, 1)
+        amount_text = f'{abs(amount):.2f} DA'
+        bg_color = (0.98, 0.98, 0.98, 1)
+        final_desc = desc
+        if not is_main_doc:
+            if amount < 0:
+                is_supplier_pay = 'règlement' in desc_lower or 'reglement' in desc_lower or 'supplier' in desc_lower or ('سداد' in desc_lower)
+                if is_supplier_pay:
+                    icon = 'cash-refund'
+                    color = (1, 0.6, 0, 1)
+                    amount_text = f'+ {abs(amount):.2f} DA'
+                    user_name = item.get('user', '')
+                    final_desc = f'Règlement ({user_name})'
+                else:
+                    icon = 'cash-plus'
+                    color = (0, 0.7, 0, 1)
+                    amount_text = f'+ {abs(amount):.2f} DA'
+                    if 'excédent' in desc_lower or 'excedent' in desc_lower:
+                        final_desc = f'Versement (Excédent)'
+                    elif 'versement' in desc_lower:
+                        final_desc = desc
+                    else:
+                        final_desc = f'Versement ({desc})'
+            else:
+                icon = 'notebook-edit'
+                color = (0.8, 0, 0, 1)
+                amount_text = f'- {abs(amount):.2f} DA'
+                if 'crédit' in desc.lower() or 'dette' in desc.lower():
+                    final_desc = desc
+                else:
+                    final_desc = f'Crédit ({desc})'
+        elif prefix == 'BV':
+            icon = 'cart'
+            color = (0, 0.5, 0.8, 1)
+        elif prefix == 'BA':
+            icon = 'truck'
+            color = (1, 0.6, 0, 1)
+        elif prefix == 'FC':
+            icon = 'file-document'
+            color = (0, 0, 0.8, 1)
+        elif prefix == 'RC':
+            icon = 'keyboard-return'
+            color = (0.8, 0, 0, 1)
+        final_sec = f"{time_str} • {item.get('user', '')}"
+        return {'raw_text': final_desc, 'raw_sec': final_sec, 'amount_text': amount_text, 'icon': icon, 'icon_color': color, 'bg_color': bg_color, 'is_local': False, 'raw_data': item, 'key': ''}
 
     def fetch_and_edit_transaction(self, item_data):
         if self.is_seller_mode:
@@ -1562,10 +3906,11 @@ class StockApp(MDApp):
             self.notify('Erreur chargement détails', 'error')
             if hasattr(self, 'entity_hist_dialog'):
                 self.entity_hist_dialog.open()
-        UrlRequest(url, on_success=on_details_success, on_failure=on_details_fail, on_error=on_details_fail)
+        self.api.request(url, on_success=on_details_success, on_failure=on_details_fail, on_error=on_details_fail)
 
     def open_entity_history_dialog(self, entity):
         self.history_target_entity = entity
+        self.history_target_kind = 'suppliers' if self.current_entity_type_mgmt == 'supplier' else 'clients'
         content = MDBoxLayout(orientation='vertical', size_hint_y=None, height=dp(550))
         tabs_box = MDBoxLayout(orientation='horizontal', size_hint_y=None, height=dp(50), spacing=5)
         self.btn_ent_hist_today = MDRaisedButton(text='AUJ.', size_hint_x=0.33, elevation=0, on_release=lambda x: self.filter_entity_history_list(day_offset=0))
@@ -1575,7 +3920,7 @@ class StockApp(MDApp):
         tabs_box.add_widget(self.btn_ent_hist_yesterday)
         tabs_box.add_widget(self.btn_ent_hist_date)
         content.add_widget(tabs_box)
-        self.rv_entity_history = HistoryRecycleView()
+        self.rv_entity_history = EntityHistoryRecycleView()
         content.add_widget(self.rv_entity_history)
         title_text = self.fix_text(f"Historique: {entity['name']}")
         self.entity_hist_dialog = MDDialog(title=title_text, type='custom', content_cls=content, size_hint=(0.95, 0.9))
@@ -1665,7 +4010,7 @@ class StockApp(MDApp):
                 entity_type_to_refresh = 'account' if base_type == 'client_pay' else 'supplier'
                 self.fetch_entities(entity_type_to_refresh)
                 release_lock_and_finish()
-            UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_payment', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_success, on_error=lambda r, e: [self.submit_simple_payment_offline(data), release_lock_and_finish()], on_failure=lambda r, e: [self.submit_simple_payment_offline(data), release_lock_and_finish()])
+            self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_payment', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_success, on_error=lambda r, e: [self.submit_simple_payment_offline(data), release_lock_and_finish()], on_failure=lambda r, e: [self.submit_simple_payment_offline(data), release_lock_and_finish()])
         else:
             self.submit_simple_payment_offline(data)
             release_lock_and_finish()
@@ -1673,7 +4018,7 @@ class StockApp(MDApp):
     def submit_simple_payment_offline(self, data):
         self.save_to_history(data, synced=False)
         change = -float(data['amount'])
-        self.update_local_entity_balance(data['entity_id'], change)
+        self.update_local_entity_balance(data['entity_id'], change, self.entity_kind(data))
         if hasattr(self, 'mgmt_dialog') and self.mgmt_dialog:
             target_list = self.all_clients if data['type'] == 'client_pay' else self.all_suppliers
             self.populate_entity_manager_list(target_list)
@@ -1770,11 +4115,7 @@ class StockApp(MDApp):
         else:
             key = 'clients' if entity_type == 'account' else 'suppliers'
             if self.cache_store.exists(key):
-                data = self.cache_store.get(key)['data']
-                if entity_type == 'account':
-                    self.all_clients = data
-                else:
-                    self.all_suppliers = data
+                self._load_cached_entities(key)
         content = MDBoxLayout(orientation='vertical', size_hint_y=None, height=dp(600))
         self.entity_search = SmartTextField(hint_text='Rechercher...', icon_right='magnify')
         self.entity_search.bind(text=lambda instance, text: self.filter_entities_for_manager(text))
@@ -1796,27 +4137,29 @@ class StockApp(MDApp):
             query = text_arg
         if self._entity_search_event:
             self._entity_search_event.cancel()
-        self._entity_search_event = Clock.schedule_once(lambda dt: self._start_mgmt_background_search(query), 0.3)
+        self._entity_search_event = Clock.schedule_once(lambda dt: self._start_mgmt_background_search(query), self.search_executor.delay('manager'))
 
     def _start_mgmt_background_search(self, text):
-        threading.Thread(target=self._mgmt_search_worker, args=(text,), daemon=True).start()
+        self.search_executor.submit('manager', self._mgmt_search_worker, text)
 
-    def _mgmt_search_worker(self, text):
+    def _mgmt_search_worker(self, job, text):
         source = self.all_clients if self.current_entity_type_mgmt == 'account' else self.all_suppliers
         if not text:
-            self.populate_entity_manager_list(source[:50])
+            job.publish(self.populate_entity_manager_list, source[:50])
             return
         txt = text.lower()
-        filtered = [e for e in source if txt in str(e.get('name', '')).lower()]
+        filtered = [e for e in job.scan(source) if txt in str(e.get('name', '')).lower()]
         if not filtered:
             try:
                 fixed_query = self.fix_text(txt)
-                filtered = [e for e in source if fixed_query in self.fix_text(str(e.get('name', '')))]
+                filtered = [e for e in job.scan(source) if fixed_query in self.fix_text(str(e.get('name', '')))]
+            except SearchCancelled:
+                raise
             except Exception:
                 pass
         if len(filtered) > 50:
             filtered = filtered[:50]
-        self.populate_entity_manager_list(filtered)
+        job.publish(self.populate_entity_manager_list, filtered)
 
     @mainthread
     def populate_entity_manager_list(self, entities):
@@ -1926,7 +4269,7 @@ class StockApp(MDApp):
                     cat_ar = 'تجزئة'
             payload = {'action': 'update' if is_edit else 'add', 'type': self.current_entity_type_mgmt, 'name': name_val, 'phone': f_phone.get_value().strip(), 'address': f_address.get_value().strip(), 'activity': f_activity.get_value().strip(), 'email': f_email.get_value().strip(), 'price_category': cat_ar, 'rc': f_rc.get_value().strip(), 'nif': f_nif.get_value().strip(), 'nis': f_nis.get_value().strip(), 'nai': f_nai.get_value().strip(), 'id': entity.get('id') if is_edit else None}
             if self.is_server_reachable:
-                UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/manage_entity', req_body=json.dumps(payload), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: [self.ae_dialog.dismiss(), self.notify('Enregistré avec succès', 'success'), self.fetch_entities(self.current_entity_type_mgmt)], on_failure=lambda r, e: self.notify(f'Erreur: {e}', 'error'))
+                self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/manage_entity', req_body=json.dumps(payload), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: [self.ae_dialog.dismiss(), self.notify('Enregistré avec succès', 'success'), self.fetch_entities(self.current_entity_type_mgmt)], on_failure=lambda r, e: self.notify(f'Erreur: {e}', 'error'))
             else:
                 self.notify('Impossible: Mode Hors Ligne', 'error')
         self.ae_dialog = MDDialog(title=title, type='custom', content_cls=scroll_container, buttons=[MDFlatButton(text='ANNULER', on_release=lambda x: self.ae_dialog.dismiss()), MDRaisedButton(text='ENREGISTRER', on_release=save)])
@@ -1959,7 +4302,7 @@ class StockApp(MDApp):
                 self.del_conf_dialog.dismiss()
             payload = {'action': 'delete', 'id': entity['id'], 'type': self.current_entity_type_mgmt}
             if self.is_server_reachable:
-                UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/manage_entity', req_body=json.dumps(payload), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: [self.notify('Compte supprimé', 'success'), self.fetch_entities(self.current_entity_type_mgmt)], on_failure=lambda r, e: self.notify('Impossible (Contient des opérations)', 'error'))
+                self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/manage_entity', req_body=json.dumps(payload), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: [self.notify('Compte supprimé', 'success'), self.fetch_entities(self.current_entity_type_mgmt)], on_failure=lambda r, e: self.notify('Impossible (Contient des opérations)', 'error'))
             else:
                 self.notify('Erreur connexion', 'error')
         name_display = self.fix_text(entity['name'])
@@ -1969,43 +4312,28 @@ class StockApp(MDApp):
     def check_server_heartbeat(self, dt):
         if self.sync_paused:
             self.is_server_reachable = False
+            self.health_monitor.pause()
             if self.status_bar_label:
                 self.status_bar_label.text = 'Synchronisation Arrêtée (PAUSE)'
                 self.status_bar_bg.md_bg_color = (0.8, 0, 0, 1)
             return
-        threading.Thread(target=self._run_socket_ping_logic, daemon=True).start()
-
-    def _run_socket_ping_logic(self):
-        ping_val = self._try_ping_host(self.local_server_ip)
-        if ping_val is not None:
-            self._finalize_ping_ui(True, ping_val, self.local_server_ip)
-            return
-        if self.external_server_ip:
-            ping_val_ext = self._try_ping_host(self.external_server_ip)
-            if ping_val_ext is not None:
-                self._finalize_ping_ui(True, ping_val_ext, self.external_server_ip)
-                return
-        self._finalize_ping_ui(False, 0, None)
+        hosts = self.server_hosts()
+        self.endpoints.set_hosts(hosts)
+        self.health_monitor.set_hosts(*hosts)
+        self.health_monitor.poke()
 
-    def _try_ping_host(self, ip_address):
-        if not ip_address:
-            return None
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(2.0)
-            start_time = time.time()
-            sock.connect((ip_address, int(DEFAULT_PORT)))
-            sock.close()
-            end_time = time.time()
-            return int((end_time - start_time) * 1000)
-        except:
-            return None
+    def server_hosts(self):
+        return [self.local_server_ip, self.external_server_ip] + list(self.alt_server_ips)
 
     @mainthread
-    def _finalize_ping_ui(self, success, ping_val, confirmed_ip):
-        if success:
-            self.last_ping = ping_val
-            self.active_server_ip = confirmed_ip
+    def _finalize_ping_ui(self, result):
+        if self.sync_paused:
+            return
+        if self.endpoints.observe_health(result['links']):
+            self.active_server_ip = self.endpoints.select()
+            link = result['links'].get(self.active_server_ip) or {}
+            self.ping_rtt = link.get('rtt', 0)
+            self.ping_jitter = link.get('jitter', 0)
             self._on_heartbeat_success()
         else:
             self._on_heartbeat_fail_final(None, 'Connection Failed')
@@ -2022,10 +4350,10 @@ class StockApp(MDApp):
             self.status_bar_bg.md_bg_color = (0.8, 0, 0, 1)
             return
         self._notify_event = None
-        pending = len([k for k in self.offline_store.keys() if not self.offline_store.get(k).get('synced', False)])
+        pending = self.offline_store.pending_count()
         ping_display = ''
         bg_color = (0.4, 0.4, 0.4, 1)
-        ping_val = getattr(self, 'last_ping', 0)
+        ping_val = self.ping_rtt
         if self.is_server_reachable:
             if ping_val < 100:
                 bg_color = (0, 0.7, 0, 1)
@@ -2033,13 +4361,16 @@ class StockApp(MDApp):
                 bg_color = (0.9, 0.5, 0, 1)
             else:
                 bg_color = (0.8, 0, 0, 1)
-            ping_display = f' • [color=FFFFFF][b][size=16sp]{ping_val}ms[/size][/b][/color]'
+            jitter_display = f' ±{self.ping_jitter}' if self.ping_jitter >= 10 else ''
+            ping_display = f' • [color=FFFFFF][b][size=16sp]{ping_val}ms{jitter_display}[/size][/b][/color]'
         if pending > 0:
             if self.is_server_reachable and ping_val >= 300:
                 self.status_bar_bg.md_bg_color = (0.8, 0, 0, 1)
             else:
                 self.status_bar_bg.md_bg_color = (0.9, 0.5, 0, 1)
-            self.status_bar_label.text = f'En attente de sync: {pending}{ping_display}'
+            parked = self.offline_store.parked_count()
+            parked_display = f' ({parked} bloqué)' if parked else ''
+            self.status_bar_label.text = f'En attente de sync: {pending}{parked_display}{ping_display}'
         elif self.is_server_reachable:
             net = 'Local' if self.active_server_ip == self.local_server_ip else 'Ext'
             self.status_bar_bg.md_bg_color = bg_color
@@ -2051,7 +4382,7 @@ class StockApp(MDApp):
     def fetch_store_info(self):
         if self.is_server_reachable:
             url = f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/store_info'
-            UrlRequest(url, on_success=self.save_store_info_callback)
+            self.api.request(url, on_success=self.save_store_info_callback, coalesce=True)
 
     def save_store_info_callback(self, req, res):
         if res:
@@ -2059,8 +4390,7 @@ class StockApp(MDApp):
 
     def _on_heartbeat_success(self):
         self.is_server_reachable = True
-        unsynced = [k for k in self.offline_store.keys() if not self.offline_store.get(k).get('synced', False)]
-        if unsynced:
+        if self.offline_store.pending_count():
             self.try_sync_offline_data()
         if self.is_offline_mode:
             self.is_offline_mode = False
@@ -2091,39 +4421,109 @@ class StockApp(MDApp):
             return
         if not self.is_server_reachable:
             return
-        keys = list(self.offline_store.keys())
-        unsynced = [k for k in keys if not self.offline_store.get(k).get('synced', False)]
-        if not unsynced:
-            self._reset_notification_state(0)
+        if not self.offline_store.pending_count():
+            if not self.sync_scheduler.requests:
+                self._reset_notification_state(0)
             return
-        sorted_keys = sorted(unsynced, key=lambda x: int(x.split('_')[0]) if x.split('_')[0].isdigit() else 0)
-        key = sorted_keys[0]
-        try:
-            item_data = self.offline_store.get(key)
-            data = item_data['order_data']
-            endpoint = '/api/submit_payment' if data.get('is_simple_payment') else '/api/submit_order'
-
-            def next_step(*args):
-                Clock.schedule_once(lambda d: self.try_sync_offline_data(), 0.5)
-
-            def success(r, res):
-                item_data['synced'] = True
-                item_data['sync_timestamp'] = time.time()
-                if res.get('server_id'):
-                    item_data['order_data']['server_id'] = res.get('server_id')
-                if res.get('invoice_number'):
-                    item_data['order_data']['invoice_number'] = res.get('invoice_number')
-                self.offline_store.put(key, **item_data)
-                self.notify(f"Sync OK: {data.get('doc_type', 'Op')}", 'success')
-                next_step()
-
-            def failure(req, err):
+        now = time.time()
+        while True:
+            limit = SYNC_BATCH_SIZE if self.batch_sync_supported else 1
+            selected = self.sync_scheduler.next_batch(self.offline_store, now, limit)
+            if not selected:
+                break
+            self.sync_scheduler.start(selected)
+            keys = [key for key, lane in selected]
+            try:
+                if self.batch_sync_supported:
+                    self._sync_batch(keys)
+                else:
+                    self._sync_single(keys[0])
+            except Exception as e:
+                print(f'Sync Logic Error: {e}')
+                self.sync_scheduler.transport_failed(keys, now)
+                self.sync_scheduler.request_done()
+                break
+        self._schedule_sync_wakeup()
+
+    def _schedule_sync_wakeup(self):
+        if self._sync_wakeup_event:
+            self._sync_wakeup_event.cancel()
+            self._sync_wakeup_event = None
+        delay = self.sync_scheduler.next_wakeup(time.time())
+        if delay is not None:
+            self._sync_wakeup_event = Clock.schedule_once(lambda d: self.try_sync_offline_data(), delay)
+
+    def _sync_request_done(self):
+        self.sync_scheduler.request_done()
+        Clock.schedule_once(lambda d: self.try_sync_offline_data(), 0)
+
+    def _sync_endpoint(self, data):
+        return 'submit_payment' if data.get('is_simple_payment') else 'submit_order'
+
+    def _sync_item_rejected(self, key, error):
+        print(f'Sync Fail for {key}: {error}')
+        if self.sync_scheduler.rejected(key, time.time()):
+            self.offline_store.park(key, error)
+            self.notify(f'Sync bloqué: {key}', 'error')
+
+    def _sync_single(self, key):
+        data = self.offline_store.get(key)['order_data']
+        endpoint = self._sync_endpoint(data)
+
+        def success(r, res):
+            self.offline_store.ack(key, server_id=res.get('server_id'), invoice_number=res.get('invoice_number'))
+            self.sync_scheduler.succeeded(key)
+            self.notify(f"Sync OK: {data.get('doc_type', 'Op')}", 'success')
+            self._sync_request_done()
+
+        def failure(req, err):
+            status = req.resp_status or 0
+            if 400 <= status < 500:
+                self._sync_item_rejected(key, err)
+            else:
                 print(f'Sync Fail for {key}: {err}')
-                next_step()
-            UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}{endpoint}', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=success, on_failure=failure, on_error=failure, timeout=10)
-        except Exception as e:
-            print(f'Sync Logic Error: {e}')
-            Clock.schedule_once(lambda d: self.try_sync_offline_data(), 1)
+                self.sync_scheduler.transport_failed([key], time.time())
+            self._sync_request_done()
+        self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/{endpoint}', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=success, on_failure=failure, on_error=failure, timeout=10, compress=True)
+
+    def _sync_batch(self, keys):
+        items = []
+        for key in keys:
+            data = self.offline_store.get(key)['order_data']
+            items.append({'key': key, 'endpoint': self._sync_endpoint(data), 'data': data})
+
+        def success(r, res):
+            synced = 0
+            answered = set()
+            for result in (res or {}).get('results', []):
+                key = result.get('key')
+                if key not in keys or key in answered:
+                    continue
+                answered.add(key)
+                if result.get('status') == 'success':
+                    if self.offline_store.exists(key):
+                        self.offline_store.ack(key, server_id=result.get('server_id'), invoice_number=result.get('invoice_number'))
+                    self.sync_scheduler.succeeded(key)
+                    synced += 1
+                else:
+                    self._sync_item_rejected(key, result.get('error'))
+            for key in keys:
+                if key not in answered:
+                    self._sync_item_rejected(key, 'Pas de réponse')
+            if synced:
+                self.notify(f'Sync OK: {synced}/{len(items)}', 'success')
+            self._sync_request_done()
+
+        def failure(req, err):
+            if req.resp_status in (404, 405):
+                self.batch_sync_supported = False
+                for key in keys:
+                    self.sync_scheduler.release(key)
+            else:
+                print(f'Batch Sync Fail: {err}')
+                self.sync_scheduler.transport_failed(keys, time.time())
+            self._sync_request_done()
+        self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_batch', req_body=json.dumps({'items': items}), req_headers={'Content-type': 'application/json'}, method='POST', on_success=success, on_failure=failure, on_error=failure, timeout=30, compress=True)
 
     def toggle_sync(self):
         if self.sync_paused:
@@ -2143,10 +4543,12 @@ class StockApp(MDApp):
         if self.sync_paused:
             action_items[0] = ['sync-off', lambda x: self.toggle_sync()]
             self.is_server_reachable = False
+            self.health_monitor.pause()
             self.notify('SYNC ARRÊTÉE', 'error')
         else:
             action_items[0] = ['sync', lambda x: self.toggle_sync()]
             self.notify('SYNC ACTIVE... Connexion', 'success')
+            self.sync_scheduler.reset()
             self.check_server_heartbeat(0)
         self.dash_toolbar.right_action_items = action_items
 
@@ -2161,7 +4563,7 @@ class StockApp(MDApp):
         self._notify_event = Clock.schedule_once(self._reset_notification_state, 3)
 
     def change_status_to_ready(self, dt):
-        pending = len([k for k in self.offline_store.keys() if not self.offline_store.get(k).get('synced', False)])
+        pending = self.offline_store.pending_count()
         if self.is_server_reachable and (not self.sync_paused) and (pending == 0):
             self.status_bar_label.text = 'Prêt'
             self.status_bar_bg.md_bg_color = (0.15, 0.5, 0.15, 1)
@@ -2178,7 +4580,7 @@ class StockApp(MDApp):
         self.notify('Connexion...', 'info')
         url = f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/login'
         body = json.dumps({'username': self.username_field.get_value(), 'password': self.password_field.get_value()})
-        UrlRequest(url, req_body=body, req_headers={'Content-type': 'application/json'}, method='POST', on_success=self.login_success, on_failure=self.login_fail, on_error=self.login_error, timeout=4)
+        self.api.request(url, req_body=body, req_headers={'Content-type': 'application/json'}, method='POST', on_success=self.login_success, on_failure=self.login_fail, on_error=self.login_error, timeout=4)
 
     def login_success(self, req, res):
         if res.get('status') == 'success':
@@ -2205,16 +4607,15 @@ class StockApp(MDApp):
         if self.store.exists('credentials'):
             creds = self.store.get('credentials')
             if self.username_field.get_value() == creds.get('username', '') and self.password_field.get_value() == creds.get('password', ''):
-                if self.cache_store.exists('products'):
+                if self.has_local_catalogue():
                     self.notify('Mode Hors Ligne', 'warning')
                     self.is_offline_mode = True
                     self.current_user_name = self.username_field.get_value()
                     self.sm.current = 'dashboard'
                     self.load_products_from_cache()
-                    if self.cache_store.exists('clients'):
-                        self.all_clients = self.cache_store.get('clients')['data']
-                    if self.cache_store.exists('suppliers'):
-                        self.all_suppliers = self.cache_store.get('suppliers')['data']
+                    for key in EntityIndex.KINDS:
+                        if self.cache_store.exists(key):
+                            self._load_cached_entities(key)
                     self.check_and_load_stats()
                 else:
                     self.notify('Pas de données locales', 'error')
@@ -2750,8 +5151,10 @@ class StockApp(MDApp):
         server_card.add_widget(MDLabel(text='Configuration Serveur', font_style='Subtitle2', theme_text_color='Primary', bold=True))
         self.local_ip_field = MDTextField(text=self.local_server_ip, hint_text='IP Local', icon_right='lan-connect')
         self.external_ip_field = MDTextField(text=self.external_server_ip, hint_text='IP Externe', icon_right='web')
+        self.alt_ips_field = MDTextField(text=', '.join(self.alt_server_ips), hint_text='IPs Alternatives (séparées par virgule)', icon_right='server-network')
         server_card.add_widget(self.local_ip_field)
         server_card.add_widget(self.external_ip_field)
+        server_card.add_widget(self.alt_ips_field)
         box.add_widget(server_card)
         box.add_widget(MDBoxLayout(size_hint_y=None, height='1dp', md_bg_color=(0.9, 0.9, 0.9, 1)))
         printer_card = MDBoxLayout(orientation='vertical', adaptive_height=True, spacing='10dp')
@@ -2791,14 +5194,16 @@ class StockApp(MDApp):
     def save_ip(self, x):
         local_ip = self.local_ip_field.text
         ext_ip = self.external_ip_field.text
+        alt_ips = [ip.strip() for ip in self.alt_ips_field.text.replace(';', ',').split(',') if ip.strip()]
         p_name = self.printer_name_field.text
         p_mac = getattr(self, 'temp_selected_mac', '')
         p_auto = self.chk_auto_print.active
         if DataValidator.validate_ip(local_ip):
             self.local_server_ip = local_ip
             self.external_server_ip = ext_ip
+            self.alt_server_ips = alt_ips
             self.active_server_ip = local_ip
-            self.store.put('config', ip=self.local_server_ip, ext_ip=self.external_server_ip, seller_mode=self.is_seller_mode)
+            self.store.put('config', ip=self.local_server_ip, ext_ip=self.external_server_ip, alt_ips=self.alt_server_ips, seller_mode=self.is_seller_mode, gzip_upload=self.gzip_upload)
             self.store.put('printer_config', name=p_name, mac=p_mac, auto=p_auto)
             if self.dialog:
                 self.dialog.dismiss()
@@ -2844,31 +5249,231 @@ class StockApp(MDApp):
 
     def on_seller_mode_switch(self, instance, value):
         self.is_seller_mode = value
-        self.store.put('config', ip=self.local_server_ip, ext_ip=self.external_server_ip, seller_mode=value)
+        self.store.put('config', ip=self.local_server_ip, ext_ip=self.external_server_ip, alt_ips=self.alt_server_ips, seller_mode=value, gzip_upload=self.gzip_upload)
         self.update_dashboard_layout()
         self.notify(f"Mode Vendeur: {('Activé' if value else 'Désactivé')}", 'info')
 
     def fetch_products(self):
-        UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/products', on_success=self.on_products_loaded)
+        if self._products_fetch_active:
+            if self.api.write_epoch != self._products_fetch_epoch:
+                self._products_refetch = True
+            return
+        if self.api.is_fresh(self._products_fetch_stamp):
+            return
+        url = f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/products'
+        headers = {}
+        version = self.catalogue_version
+        if version and self.all_products_raw:
+            url += '?since=' + quote(version.strip('"'))
+            headers['If-None-Match'] = version if version.startswith('"') else f'"{version}"'
+        self._products_fetch_active = True
+        self._products_fetch_epoch = self.api.write_epoch
+        build = ProductStreamBuild()
+        self.api.stream(url, req_headers=headers, on_items=lambda req, items: self._on_product_rows(build, items), on_success=lambda req, res: self.on_products_loaded(req, res, build), on_failure=lambda req, res: self._on_products_fetch_failed(build, res), on_error=lambda req, err: self._on_products_fetch_failed(build, err), on_redirect=self.on_products_not_modified)
+
+    def _products_fetch_done(self, fresh):
+        self._products_fetch_active = False
+        if fresh:
+            self._products_fetch_stamp = self.api.stamp(self._products_fetch_epoch)
+        if self._products_refetch:
+            self._products_refetch = False
+            Clock.schedule_once(lambda dt: self.fetch_products(), 0)
+
+    def on_products_not_modified(self, req, res):
+        self._products_fetch_done(req.resp_status == 304)
+        if req.resp_status != 304:
+            print(f'Products Fetch Redirect: {req.resp_status}')
+
+    def _on_products_fetch_failed(self, build, err):
+        self._products_fetch_done(False)
+        print(f'Products Fetch Error: {err}')
+        if build.streamed:
+            self._queue_catalogue_write(self._abort_catalogue_stream, build)
+
+    def _on_product_rows(self, build, items):
+        start = len(build.products)
+        build.add(items)
+        if not build.streamed:
+            build.streamed = True
+            self._queue_catalogue_write(self._begin_catalogue_stream, build)
+            self._show_first_product_page(build, build.products[:self.batch_size])
+        self._queue_catalogue_write(self._stream_catalogue_rows, build, start, list(items))
 
-    def on_products_loaded(self, req, res):
+    @mainthread
+    def _show_first_product_page(self, build, page):
+        if not self.all_products_raw:
+            build.first_page = page
+            self.prepare_products_for_rv(page)
+
+    def _begin_catalogue_stream(self, build):
+        try:
+            if self.catalogue_store:
+                self.catalogue_store.begin_replace()
+        except Exception as e:
+            build.store_ok = False
+            print(f'Catalogue Save Error: {e}')
+
+    def _stream_catalogue_rows(self, build, start, rows):
+        if not build.store_ok or not self.catalogue_store:
+            return
+        try:
+            self.catalogue_store.append_rows(start, rows)
+        except Exception as e:
+            build.store_ok = False
+            print(f'Catalogue Save Error: {e}')
+
+    def _commit_catalogue_stream(self, build, version):
+        if self.catalogue_store and build.store_ok:
+            try:
+                self.catalogue_store.commit_replace(version)
+                Clock.schedule_once(lambda dt: self._drop_legacy_products_cache(), 0)
+                return
+            except Exception as e:
+                print(f'Catalogue Save Error: {e}')
+        self._abort_catalogue_stream(build)
+        self._save_catalogue_worker(list(build.products), version)
+
+    def _abort_catalogue_stream(self, build):
         try:
-            self.all_products_raw = res
-            Clock.schedule_once(lambda dt: self.cache_store.put('products', data=res), 0.1)
-            self.prepare_products_for_rv(res)
+            if self.catalogue_store:
+                self.catalogue_store.abort_replace()
+        except Exception as e:
+            print(f'Catalogue Save Error: {e}')
+
+    def _response_version(self, req, res):
+        if isinstance(res, dict) and res.get('version'):
+            return str(res['version'])
+        for k, v in (req.resp_headers or {}).items():
+            if k.lower() == 'etag':
+                return str(v)
+        return ''
+
+    def on_products_loaded(self, req, res, build=None):
+        self._products_fetch_done(True)
+        try:
+            version = self._response_version(req, res)
+            if build is not None and build.streamed and isinstance(res, list) and len(res) == len(build.products):
+                self.all_products_raw = build.products
+                self.product_table = build.table
+                self.catalogue_version = version
+                self._index_generation += 1
+                self.barcode_index = build.barcodes
+                self.product_index = build.index
+                self.pin_display_names('products', build.products)
+                self._queue_catalogue_write(self._commit_catalogue_stream, build, version)
+                cursor = self.product_cursor
+                if build.first_page is not None and cursor is not None and cursor.source is build.first_page:
+                    cursor.rebase(build.products)
+                else:
+                    self.prepare_products_for_rv(build.products)
+                return
+            if build is not None and build.streamed:
+                self._queue_catalogue_write(self._abort_catalogue_stream, build)
+            if isinstance(res, dict) and (not res.get('full')) and ('changed' in res or 'deleted' in res):
+                if self.all_products_raw:
+                    self.apply_products_delta(res.get('changed') or [], res.get('deleted') or [], version)
+                else:
+                    self.catalogue_version = ''
+                    self.fetch_products()
+                return
+            if isinstance(res, dict):
+                res = res.get('products') or []
+            self.product_table = ProductTable()
+            self.all_products_raw = self.product_table.extend(res)
+            self.catalogue_version = version
+            self.rebuild_product_index()
+            self._queue_catalogue_write(self._save_catalogue_worker, list(res), version)
+            self.prepare_products_for_rv(self.all_products_raw)
         except Exception as e:
             print(f'Error loading products: {e}')
 
+    def apply_products_delta(self, changed, deleted, version):
+        products = self.all_products_raw
+        deleted_ids = set((str(i) for i in deleted))
+        if self.product_table is None:
+            self.product_table = ProductTable()
+        changed_by_id = {str(p.get('id')): self.product_table.append(p) for p in changed if str(p.get('id')) not in deleted_ids}
+        self.catalogue_version = version or self.catalogue_version
+        self.row_cache.invalidate(list(deleted_ids) + list(changed_by_id), self.catalogue_version)
+        self.query_cache.clear()
+        if deleted_ids or changed_by_id:
+            index = self.product_index if self.product_index is not None and self.product_index.source is products else None
+            barcodes = self.barcode_index if self.barcode_index is not None and self.barcode_index.source is products else None
+            pending = dict(changed_by_id)
+            kept = []
+            for p in products:
+                pid = str(p.get('id'))
+                if pid in deleted_ids:
+                    if barcodes:
+                        barcodes.remove(p)
+                    self.product_table.release(p)
+                    continue
+                new_p = pending.pop(pid, None)
+                if new_p is not None:
+                    if barcodes:
+                        barcodes.remove(p)
+                        barcodes.add(new_p)
+                    self.product_table.release(p)
+                    p = new_p
+                kept.append(p)
+            for new_p in pending.values():
+                kept.append(new_p)
+                if barcodes:
+                    barcodes.add(new_p)
+            products[:] = kept
+            if self.product_table.needs_compaction():
+                self.product_table = ProductTable()
+                products[:] = self.product_table.extend(products)
+                self.rebuild_product_index()
+            elif index is not None and barcodes is not None:
+                for pid in deleted_ids:
+                    index.remove(pid)
+                for p in changed_by_id.values():
+                    index.update(p)
+            else:
+                self.rebuild_product_index()
+            self.refresh_product_results()
+        self._queue_catalogue_write(self._save_catalogue_delta_worker, list(changed_by_id.values()), list(deleted_ids), self.catalogue_version)
+
+    def refresh_product_results(self):
+        field = getattr(self, 'search_field', None)
+        query = field.get_value() if field is not None and hasattr(field, 'get_value') else ''
+        if query:
+            self._start_background_search(query)
+        else:
+            self.prepare_products_for_rv(self.all_products_raw)
+
+    def rebuild_product_index(self):
+        self._index_generation += 1
+        self.pin_display_names('products', self.all_products_raw)
+        threading.Thread(target=self._product_index_worker, args=(self.all_products_raw, self._index_generation), daemon=True).start()
+
+    def _product_index_worker(self, products, generation):
+        try:
+            barcodes = BarcodeIndex(products)
+            if generation == self._index_generation:
+                self.barcode_index = barcodes
+            index = ProductSearchIndex(products)
+            if generation == self._index_generation:
+                self.product_index = index
+        except Exception as e:
+            print(f'Index Build Error: {e}')
+
     def fetch_entities(self, type_):
-        UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/entities?type={type_}', on_success=lambda r, x: self.on_entities_loaded(type_, x))
+        self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/entities?type={type_}', on_success=lambda r, x: self.on_entities_loaded(type_, x), coalesce=True)
 
-    def on_entities_loaded(self, type_, data):
-        key = 'clients' if type_ == 'account' else 'suppliers'
-        if type_ == 'account':
+    def _set_entities(self, key, data):
+        if key == 'clients':
             self.all_clients = data
         else:
             self.all_suppliers = data
-        Clock.schedule_once(lambda dt: self.cache_store.put(key, data=data), 0.1)
+        self.entity_index.set(key, data)
+        self.pin_display_names(key, data)
+
+    def on_entities_loaded(self, type_, data):
+        key = 'clients' if type_ == 'account' else 'suppliers'
+        self._set_entities(key, data)
+        Clock.schedule_once(lambda dt: self._persist_entities(key), 0.1)
         if hasattr(self, 'mgmt_dialog') and self.mgmt_dialog:
             try:
                 if self.current_entity_type_mgmt == type_:
@@ -2876,35 +5481,109 @@ class StockApp(MDApp):
             except:
                 pass
 
+    def has_local_catalogue(self):
+        try:
+            if self.catalogue_store and self.catalogue_store.count() > 0:
+                return True
+        except Exception as e:
+            print(f'Catalogue Error: {e}')
+        return bool(self.cache_store and self.cache_store.exists('products'))
+
+    def _queue_catalogue_write(self, fn, *args):
+        if self.catalogue_writer:
+            self.catalogue_writer.submit(fn, *args)
+        else:
+            threading.Thread(target=fn, args=args, daemon=True).start()
+
+    def _save_catalogue_worker(self, products, version=None):
+        try:
+            if self.catalogue_store:
+                self.catalogue_store.replace_all(products, version)
+                Clock.schedule_once(lambda dt: self._drop_legacy_products_cache(), 0)
+            else:
+                Clock.schedule_once(lambda dt: self.cache_store.put('products', data=[p.copy() for p in products]), 0)
+        except Exception as e:
+            print(f'Catalogue Save Error: {e}')
+
+    def _save_catalogue_delta_worker(self, changed, deleted, version):
+        try:
+            if self.catalogue_store:
+                self.catalogue_store.apply_delta(changed, deleted, version)
+            else:
+                Clock.schedule_once(lambda dt: self.cache_store.put('products', data=[p.copy() for p in self.all_products_raw]), 0)
+        except Exception as e:
+            print(f'Catalogue Save Error: {e}')
+
+    def _drop_legacy_products_cache(self):
+        try:
+            if self.cache_store.exists('products'):
+                self.cache_store.delete('products')
+        except Exception as e:
+            print(f'Cache Cleanup Error: {e}')
+
     def load_products_from_cache(self):
+        try:
+            if self.catalogue_store and self.catalogue_store.count() > 0:
+                self.show_product_cursor(self.browse_products())
+                threading.Thread(target=self._hydrate_catalogue_worker, daemon=True).start()
+                return
+        except Exception as e:
+            print(f'Catalogue Load Error: {e}')
         if self.cache_store.exists('products'):
-            self.all_products_raw = self.cache_store.get('products')['data']
+            self.product_table = ProductTable()
+            self.all_products_raw = self.product_table.extend(self.cache_store.get('products')['data'])
+            self.rebuild_product_index()
             self.prepare_products_for_rv(self.all_products_raw)
+            if self.catalogue_store:
+                self._queue_catalogue_write(self._save_catalogue_worker, list(self.all_products_raw))
+
+    def _hydrate_catalogue_worker(self):
+        try:
+            version = self.catalogue_store.get_meta('version', '')
+            table = ProductTable()
+            products = table.extend(self.catalogue_store.load_all())
+            self._on_catalogue_hydrated(products, version, table)
+        except Exception as e:
+            print(f'Catalogue Load Error: {e}')
+
+    @mainthread
+    def _on_catalogue_hydrated(self, products, version='', table=None):
+        if self.all_products_raw:
+            return
+        self.all_products_raw = products
+        self.product_table = table
+        self.catalogue_version = version
+        self.rebuild_product_index()
+        cursor = self.product_cursor
+        if cursor is not None and cursor.kind == 'catalogue':
+            cursor.rebase(products)
 
     def filter_entities(self, instance, text=None):
         query = instance.get_value() if hasattr(instance, 'get_value') else text
         if self._entity_search_event:
             self._entity_search_event.cancel()
-        self._entity_search_event = Clock.schedule_once(lambda dt: self._start_entity_background_search(query), 0.3)
+        self._entity_search_event = Clock.schedule_once(lambda dt: self._start_entity_background_search(query), self.search_executor.delay('entities'))
 
     def _start_entity_background_search(self, query):
-        threading.Thread(target=self._entity_search_worker, args=(query,), daemon=True).start()
+        self.search_executor.submit('entities', self._entity_search_worker, query)
 
-    def _entity_search_worker(self, query):
+    def _entity_search_worker(self, job, query):
         if not query:
-            self.populate_entity_list(self.entities_source[:50])
+            job.publish(self.populate_entity_list, self.entities_source[:50])
             return
         txt = query.lower()
-        filtered = [e for e in self.entities_source if txt in str(e.get('name', '')).lower() or txt in str(e.get('phone', '')).lower()]
+        filtered = [e for e in job.scan(self.entities_source) if txt in str(e.get('name', '')).lower() or txt in str(e.get('phone', '')).lower()]
         if not filtered:
             try:
                 fixed_query = self.fix_text(txt)
-                filtered = [e for e in self.entities_source if fixed_query in self.fix_text(str(e.get('name', '')))]
+                filtered = [e for e in job.scan(self.entities_source) if fixed_query in self.fix_text(str(e.get('name', '')))]
+            except SearchCancelled:
+                raise
             except Exception:
                 pass
         if len(filtered) > 50:
             filtered = filtered[:50]
-        self.populate_entity_list(filtered)
+        job.publish(self.populate_entity_list, filtered)
 
     @mainthread
     def populate_entity_list(self, entities, next_action=None):
@@ -2982,6 +5661,7 @@ class StockApp(MDApp):
                 self.cart_bar.size_hint_y = None
                 self.cart_bar.opacity = 1
                 self.cart_bar.disabled = False
+        self.product_cursor = None
         if self.rv_products:
             self.rv_products.data = []
             self.rv_products.refresh_from_data()
@@ -3029,19 +5709,19 @@ class StockApp(MDApp):
         if is_sale_context:
             has_promo = product.get('has_promo', False)
             if has_promo:
-                curr_price = float(product.get('price', 0))
+                curr_price = ProductTable.number(product, 'price')
             else:
                 cat = ''
                 if self.selected_entity:
                     cat = str(self.selected_entity.get('category', ''))
                 if cat in ['Gros', 'جملة']:
-                    curr_price = product.get('price_wholesale', 0)
+                    curr_price = ProductTable.number(product, 'price_wholesale')
                 elif cat in ['Demi-Gros', 'نصف جملة']:
-                    curr_price = product.get('price_semi', 0)
-                if float(curr_price or 0) == 0:
-                    curr_price = product.get('price', 0)
+                    curr_price = ProductTable.number(product, 'price_semi')
+                if curr_price == 0:
+                    curr_price = ProductTable.number(product, 'price')
         else:
-            curr_price = product.get('purchase_price', product.get('price', 0))
+            curr_price = ProductTable.number(product, 'purchase_price' if 'purchase_price' in product else 'price')
         prod_name = self.fix_text(product.get('name'))
         price_val_str = fmt_num(curr_price or 0)
         self.active_input_target = 'qty'
@@ -3255,7 +5935,7 @@ class StockApp(MDApp):
                 except:
                     return ''
             if is_edit:
-                raw_stock = float(product.get('stock', 0) or 0.0)
+                raw_stock = ProductTable.number(product, 'stock')
             else:
                 raw_stock = 0.0
             is_unlimited = raw_stock <= -900000
@@ -3338,7 +6018,7 @@ class StockApp(MDApp):
                 def update_ref_ui(req, res):
                     if res and 'ref' in res:
                         self.field_num.text = str(res['ref'])
-                UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/get_next_ref', on_success=update_ref_ui)
+                self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/get_next_ref', on_success=update_ref_ui)
 
             def save_product(x):
                 try:
@@ -3362,7 +6042,7 @@ class StockApp(MDApp):
                             self.search_field.text = ''
                         self.fetch_products()
                         self.notify(f"Produit {('Modifié' if is_edit else 'Ajouté')} avec succès", 'success')
-                    UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}{endpoint}', req_body=json.dumps(payload), req_headers={'Content-Type': 'application/json'}, method='POST', on_success=on_save_ok, on_failure=lambda r, e: self.notify('Erreur serveur', 'error'), on_error=lambda r, e: self.notify('Erreur connexion', 'error'))
+                    self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}{endpoint}', req_body=json.dumps(payload), req_headers={'Content-Type': 'application/json'}, method='POST', on_success=on_save_ok, on_failure=lambda r, e: self.notify('Erreur serveur', 'error'), on_error=lambda r, e: self.notify('Erreur connexion', 'error'))
                 except ValueError:
                     self.notify('Valeurs numériques invalides', 'error')
                 except Exception as e:
@@ -3384,7 +6064,7 @@ class StockApp(MDApp):
                             self.search_field.text = ''
                         self.fetch_products()
                         self.notify('Produit supprimé', 'success')
-                    UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_product', req_body=json.dumps({'id': product['id']}), req_headers={'Content-Type': 'application/json'}, method='POST', on_success=on_del_ok, on_failure=lambda r, e: self.notify('Erreur suppression', 'error'))
+                    self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_product', req_body=json.dumps({'id': product['id']}), req_headers={'Content-Type': 'application/json'}, method='POST', on_success=on_del_ok, on_failure=lambda r, e: self.notify('Erreur suppression', 'error'))
                 name_disp = self.fix_text(val_name)
                 self.conf_diag = MDDialog(title='Confirmation', text=f'Supprimer {name_disp} ?', buttons=[MDFlatButton(text='NON', on_release=lambda z: self.conf_diag.dismiss()), MDRaisedButton(text='OUI', md_bg_color=(1, 0, 0, 1), on_release=confirm)])
                 self.conf_diag.open()
@@ -3409,7 +6089,7 @@ class StockApp(MDApp):
             self.notify('Quantité invalide', 'error')
             return
         try:
-            final_price = float(product.get('price', 0))
+            final_price = ProductTable.number(product, 'price')
         except:
             final_price = 0.0
         if product.get('name') == 'Autre Article':
@@ -3473,10 +6153,7 @@ class StockApp(MDApp):
         else:
             key = 'clients' if entity_type == 'account' else 'suppliers'
             if self.cache_store.exists(key):
-                if entity_type == 'account':
-                    self.all_clients = self.cache_store.get('clients')['data']
-                else:
-                    self.all_suppliers = self.cache_store.get(key)['data']
+                self._load_cached_entities(key)
         self.show_entity_selection_dialog(None, next_action=self.show_simple_payment_dialog)
 
     def show_simple_payment_dialog(self, amount=None):
@@ -3593,7 +6270,7 @@ class StockApp(MDApp):
                             else:
                                 pass
                             if reversal_amount != 0:
-                                self.update_local_entity_balance(old_data['entity_id'], -reversal_amount)
+                                self.update_local_entity_balance(old_data['entity_id'], -reversal_amount, self.entity_kind(old_data))
                 except Exception as e:
                     print(f'History update error: {e}')
         if not key_name:
@@ -3604,7 +6281,7 @@ class StockApp(MDApp):
             else:
                 doc_type = data.get('doc_type', 'BV')
                 key_name = f'{timestamp_sec}_{unique_id}_{doc_type}'
-        self.offline_store.put(key_name, order_data=data, synced=synced, sync_timestamp=time.time() if synced else 0)
+        self.offline_store.enqueue(key_name, data, synced=synced)
         self.editing_transaction_key = None
         if not synced:
             try:
@@ -4039,7 +6716,7 @@ class StockApp(MDApp):
                 self.save_to_history(data, synced=False)
                 if excess_data:
                     self.save_to_history(excess_data, synced=False)
-                    self.update_local_entity_balance(excess_data['entity_id'], excess_data['amount'])
+                    self.update_local_entity_balance(excess_data['entity_id'], excess_data['amount'], self.entity_kind(excess_data))
                 try:
                     printable_modes = ['sale', 'purchase', 'return_sale', 'return_purchase', 'transfer']
                     if self.current_mode in printable_modes:
@@ -4071,10 +6748,10 @@ class StockApp(MDApp):
                             type_refresh = 'supplier' if excess_data['type'] == 'supplier_pay' else 'account'
                             self.fetch_entities(type_refresh)
                             finalize_process()
-                        UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_payment', req_body=json.dumps(excess_data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_excess_success, on_failure=lambda r, e: [self.save_to_history(excess_data, synced=False), finalize_process()], on_error=lambda r, e: [self.save_to_history(excess_data, synced=False), finalize_process()])
+                        self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_payment', req_body=json.dumps(excess_data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_excess_success, on_failure=lambda r, e: [self.save_to_history(excess_data, synced=False), finalize_process()], on_error=lambda r, e: [self.save_to_history(excess_data, synced=False), finalize_process()])
                     else:
                         finalize_process()
-                UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_order', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_invoice_success, on_error=on_fail, on_failure=on_fail, timeout=10)
+                self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/submit_order', req_body=json.dumps(data), req_headers={'Content-type': 'application/json'}, method='POST', on_success=on_invoice_success, on_error=on_fail, on_failure=on_fail, timeout=10)
             else:
                 on_fail(None, None)
         except Exception as e:
@@ -4113,7 +6790,7 @@ class StockApp(MDApp):
                 payment_info = data.get('payment_info', {})
                 paid_amount = float(payment_info.get('amount', 0))
                 net_change = self._round_num(total_amount * balance_sign - paid_amount)
-                self.update_local_entity_balance(data['entity_id'], net_change)
+                self.update_local_entity_balance(data['entity_id'], net_change, self.entity_kind(data))
         except Exception as e:
             print(f'Error calculating offline balance update: {e}')
         self.cart = []
@@ -4157,19 +6834,12 @@ class StockApp(MDApp):
             self.btn_hist_date.text = 'CALENDRIER'
         self.history_view_date = target_date
         self.history_rv_data = []
-        keys = list(self.offline_store.keys())
+        day_start = datetime(target_date.year, target_date.month, target_date.day)
+        day_end = day_start + timedelta(days=1)
         local_items = []
-        for k in keys:
+        for k in self.offline_store.pending_keys_between(int(day_start.timestamp()), int(day_end.timestamp())):
             try:
-                item_store = self.offline_store.get(k)
-                if item_store.get('synced', False):
-                    continue
-                parts = k.split('_')
-                if parts[0].isdigit():
-                    ts_val = int(parts[0])
-                    item_date = datetime.fromtimestamp(ts_val).date()
-                    if item_date == target_date:
-                        local_items.append((ts_val, k, item_store))
+                local_items.append((OfflineJournal.key_timestamp(k), k, self.offline_store.get(k)))
             except:
                 continue
         local_items.sort(key=lambda x: x[0], reverse=True)
@@ -4189,9 +6859,7 @@ class StockApp(MDApp):
                 else:
                     entity_name = 'Dépôt -> Magasin'
             elif ent_id:
-                found = next((c for c in self.all_clients if c['id'] == ent_id), None)
-                if not found:
-                    found = next((s for s in self.all_suppliers if s['id'] == ent_id), None)
+                found = self.entity_index.get(ent_id)
                 if found:
                     entity_name = found.get('name', 'Tiers')
             else:
@@ -4278,7 +6946,7 @@ class StockApp(MDApp):
         self.rv_history.data = self.history_rv_data
         if self.is_server_reachable:
             url = f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/history?date={target_date}'
-            UrlRequest(url, on_success=self.on_history_server_loaded)
+            self.api.request(url, on_success=self.on_history_server_loaded)
         elif not self.history_rv_data:
             self.rv_history.data = [{'raw_text': 'Aucune opération locale.', 'raw_sec': '', 'amount_text': '', 'icon': 'alert-circle-outline', 'icon_color': (0.5, 0.5, 0.5, 1), 'bg_color': (1, 1, 1, 1), 'is_local': False, 'key': '', 'raw_data': None}]
 
@@ -4419,7 +7087,7 @@ class StockApp(MDApp):
                 server_id = data.get('server_id')
                 is_tr = doc_type == 'TR'
                 if server_id and self.is_server_reachable:
-                    UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_transaction', req_body=json.dumps({'server_id': server_id, 'is_transfer': is_tr}), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: self.offline_store.delete(key) or self.notify('Supprimé du Serveur', 'success'), on_failure=lambda r, e: self.notify('Echec suppression serveur', 'error'))
+                    self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_transaction', req_body=json.dumps({'server_id': server_id, 'is_transfer': is_tr}), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: self.offline_store.delete(key) or self.notify('Supprimé du Serveur', 'success'), on_failure=lambda r, e: self.notify('Echec suppression serveur', 'error'))
                 else:
                     self.offline_store.delete(key)
                     self.notify('Supprimé (Local)', 'info')
@@ -4444,9 +7112,7 @@ class StockApp(MDApp):
                 if data.get('is_simple_payment'):
                     self.current_mode = data.get('type')
                     saved_ent_id = data.get('entity_id')
-                    found = next((c for c in self.all_clients if c['id'] == saved_ent_id), None)
-                    if not found:
-                        found = next((s for s in self.all_suppliers if s['id'] == saved_ent_id), None)
+                    found = self.entity_index.get(saved_ent_id)
                     self.selected_entity = found if found else {'id': saved_ent_id, 'name': 'Inconnu'}
                     self.show_simple_payment_dialog(amount=abs(float(data.get('amount', 0))))
                     return
@@ -4463,9 +7129,7 @@ class StockApp(MDApp):
                 saved_ent_id = data.get('entity_id')
                 found_entity = None
                 if saved_ent_id:
-                    found_entity = next((c for c in self.all_clients if c['id'] == saved_ent_id), None)
-                    if not found_entity:
-                        found_entity = next((s for s in self.all_suppliers if s['id'] == saved_ent_id), None)
+                    found_entity = self.entity_index.get(saved_ent_id)
                     self.selected_entity = found_entity if found_entity else {'id': saved_ent_id, 'name': 'Client (Cache)'}
                 else:
                     self.selected_entity = {'id': None, 'name': 'COMPTOIR'}
@@ -4510,9 +7174,7 @@ class StockApp(MDApp):
         ent_id = data.get('entity_id')
         entity_name = 'COMPTOIR'
         if ent_id:
-            found = next((c for c in self.all_clients if c['id'] == ent_id), None)
-            if not found:
-                found = next((s for s in self.all_suppliers if s['id'] == ent_id), None)
+            found = self.entity_index.get(ent_id)
             if found:
                 entity_name = found.get('name', 'Tiers')
         is_transfer = doc_type == 'TR'
@@ -4688,7 +7350,7 @@ class StockApp(MDApp):
             if res.get('source_location'):
                 item_data['source_location'] = res.get('source_location')
             self.show_server_transaction_details(item_data, res)
-        UrlRequest(url, on_success=on_success_callback, on_failure=lambda r, e: self.notify('Erreur chargement détails', 'error'), on_error=lambda r, e: self.notify('Erreur connexion', 'error'))
+        self.api.request(url, on_success=on_success_callback, on_failure=lambda r, e: self.notify('Erreur chargement détails', 'error'), on_error=lambda r, e: self.notify('Erreur connexion', 'error'))
 
     def show_server_transaction_details(self, header_data, result):
         from kivymd.uix.boxlayout import MDBoxLayout
@@ -4858,6 +7520,9 @@ class StockApp(MDApp):
             return
 
         def on_success(req, result):
+            if not isinstance(result, bytes):
+                self.notify('Erreur téléchargement', 'error')
+                return
             try:
                 with open(file_path, 'wb') as f:
                     f.write(result)
@@ -4868,7 +7533,7 @@ class StockApp(MDApp):
 
         def on_fail(req, err):
             self.notify('Erreur téléchargement', 'error')
-        UrlRequest(url, on_success=on_success, on_failure=on_fail, on_error=on_fail)
+        self.api.request(url, on_success=on_success, on_failure=on_fail, on_error=on_fail)
 
     def open_pdf_file(self, file_path):
         if platform != 'android':
@@ -4916,7 +7581,7 @@ class StockApp(MDApp):
         else:
             trans_id = item_data_or_id
             is_transfer = False
-        UrlRequest(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_transaction', req_body=json.dumps({'server_id': trans_id, 'is_transfer': is_transfer}), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: self.notify('Supprimé avec succès', 'success') or self.filter_history_list(0), on_failure=lambda r, e: self.notify('Echec suppression', 'error'))
+        self.api.request(f'http://{self.active_server_ip}:{DEFAULT_PORT}/api/delete_transaction', req_body=json.dumps({'server_id': trans_id, 'is_transfer': is_transfer}), req_headers={'Content-type': 'application/json'}, method='POST', on_success=lambda r, s: self.notify('Supprimé avec succès', 'success') or self.filter_history_list(0), on_failure=lambda r, e: self.notify('Echec suppression', 'error'))
 
     def load_server_transaction_for_edit(self, header_data, items):
         if hasattr(self, 'srv_dialog') and self.srv_dialog:
@@ -4932,13 +7597,9 @@ class StockApp(MDApp):
         search_name = header_data.get('entity', '').strip()
         search_id = header_data.get('entity_id')
         if search_id:
-            found_entity = next((e for e in self.all_clients if e['id'] == search_id), None)
-            if not found_entity:
-                found_entity = next((e for e in self.all_suppliers if e['id'] == search_id), None)
+            found_entity = self.entity_index.get(search_id)
         if not found_entity and search_name:
-            found_entity = next((e for e in self.all_clients if e.get('name') == search_name), None)
-            if not found_entity:
-                found_entity = next((e for e in self.all_suppliers if e.get('name') == search_name), None)
+            found_entity = self.entity_index.find_name(search_name)
         prefix = header_data['desc'][:2]
         mode_map = {'BV': 'sale', 'BA': 'purchase', 'RC': 'return_sale', 'RF': 'return_purchase', 'TR': 'transfer', 'FC': 'invoice_sale', 'FP': 'proforma', 'FF': 'invoice_purchase', 'DP': 'order_purchase', 'BI': 'purchase'}
         mode = mode_map.get(prefix)
@@ -4948,7 +7609,7 @@ class StockApp(MDApp):
         if not mode or not items:
             is_supplier_op = any((k in full_desc for k in ['règlement', 'reglement', 'سداد', 'fournisseur']))
             if found_entity:
-                if any((s['id'] == found_entity['id'] for s in self.all_suppliers)):
+                if self.entity_index.is_supplier(found_entity):
                     is_supplier_op = True
             self.current_mode = 'supplier_payment' if is_supplier_op else 'client_payment'
             is_financial = True
@@ -5024,6 +7685,8 @@ class StockApp(MDApp):
         self.open_cart_screen()
 
     def manual_sync(self):
+        self.offline_store.unpark_all()
+        self.sync_scheduler.reset()
         self.try_sync_offline_data()
         self.notify('Synchronisation...')
 
@@ -5135,12 +7798,7 @@ class StockApp(MDApp):
             print(f'Scan Error: {e}')
 
     def process_continuous_scan(self, code):
-        found_product = None
-        for p in self.all_products_raw:
-            p_code = str(p.get('barcode', '')).strip()
-            if p_code == code:
-                found_product = p
-                break
+        found_product = self.find_product_by_barcode(code)
         if found_product:
             for item in self.temp_scanned_cart:
                 if item['id'] == found_product['id']:
@@ -5185,13 +7843,13 @@ class StockApp(MDApp):
                 customer_cat = 'Demi-Gros'
         for prod in reversed(self.temp_scanned_cart):
             prod_name = self.fix_text(prod.get('name', 'Inconnu'))
-            final_price = float(prod.get('price', 0) or 0)
+            final_price = ProductTable.number(prod, 'price')
             if customer_cat == 'Gros':
-                p_gros = float(prod.get('price_wholesale', 0) or 0)
+                p_gros = ProductTable.number(prod, 'price_wholesale')
                 if p_gros > 0:
                     final_price = p_gros
             elif customer_cat == 'Demi-Gros':
-                p_semi = float(prod.get('price_semi', 0) or 0)
+                p_semi = ProductTable.number(prod, 'price_semi')
                 if p_semi > 0:
                     final_price = p_semi
             card = MDCard(orientation='horizontal', size_hint_y=None, height=dp(75), padding=[dp(15), 0, 0, 0], radius=[0], elevation=0, md_bg_color=(1, 1, 1, 1))
@@ -5234,13 +7892,26 @@ class StockApp(MDApp):
         self.notify(f'{count} Articles ajoutés au panier', 'success')
         self.temp_scanned_cart = []
 
+    def find_product_by_barcode(self, code):
+        index = self.barcode_index
+        if index is not None and index.source is self.all_products_raw:
+            return index.lookup(code)
+        keys = BarcodeIndex.lookup_keys(code)
+        if not keys:
+            return None
+        if not self.all_products_raw and self.has_local_catalogue():
+            try:
+                return self.catalogue_store.lookup_barcode(code)
+            except Exception as e:
+                print(f'Catalogue Lookup Error: {e}')
+        for key in keys:
+            for p in self.all_products_raw:
+                if key in BarcodeIndex.product_codes(p):
+                    return p
+        return None
+
     def process_scanned_barcode(self, code):
-        found_product = None
-        for p in self.all_products_raw:
-            p_code = str(p.get('barcode', '')).strip()
-            if p_code == code:
-                found_product = p
-                break
+        found_product = self.find_product_by_barcode(code)
         if found_product:
             self.add_scanned_item_to_cart(found_product)
         else:
@@ -5251,18 +7922,17 @@ class StockApp(MDApp):
             is_sale_context = self.current_mode in ['sale', 'return_sale', 'invoice_sale', 'proforma']
             final_price = 0.0
             if is_sale_context:
-                curr_price = product.get('price', 0)
+                final_price = ProductTable.number(product, 'price')
                 if self.selected_entity:
                     cat = str(self.selected_entity.get('category', ''))
                     if cat in ['Gros', 'جملة']:
-                        curr_price = product.get('price_wholesale', 0)
+                        final_price = ProductTable.number(product, 'price_wholesale')
                     elif cat in ['Demi-Gros', 'نصف جملة']:
-                        curr_price = product.get('price_semi', 0)
-                    if float(curr_price or 0) == 0:
-                        curr_price = product.get('price', 0)
-                final_price = float(curr_price)
+                        final_price = ProductTable.number(product, 'price_semi')
+                    if final_price == 0:
+                        final_price = ProductTable.number(product, 'price')
             else:
-                final_price = float(product.get('purchase_price', product.get('price', 0)))
+                final_price = ProductTable.number(product, 'purchase_price' if 'purchase_price' in product else 'price')
             qty = 1.0
             found = False
             for item in self.cart:
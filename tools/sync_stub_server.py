@@ -0,0 +1,135 @@
+import argparse
+import gzip
+import itertools
+import json
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# ==========================================
+# Local stand-in for the MagPro server sync endpoints.
+# python tools/sync_stub_server.py [--port 5000] [--no-batch] [--reject-rate 0.1] [--products 2000] [--no-gzip-upload] [--history 500] [--no-entity-history]
+# ==========================================
+COUNTER = itertools.count(1000)
+LOCK = threading.Lock()
+RECEIVED = []
+PRODUCTS = []
+HISTORY = []
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding', '') == 'gzip':
+            raw = gzip.decompress(raw)
+        return json.loads(raw.decode('utf-8')) if raw else {}
+
+    def _submit(self, endpoint, data):
+        if random.random() < self.options.reject_rate:
+            return {'status': 'error', 'error': 'Rejected by stub'}
+        with LOCK:
+            server_id = next(COUNTER)
+            RECEIVED.append((endpoint, data))
+        result = {'status': 'success', 'server_id': server_id}
+        if endpoint == 'submit_order':
+            result['invoice_number'] = f"{data.get('doc_type', 'BV')}-{server_id}"
+        return result
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if path == '/api/ping':
+            self._send_json({'status': 'ok', 'received': len(RECEIVED)})
+        elif path == '/api/products':
+            self._send_json(PRODUCTS)
+        elif path == '/api/history':
+            self._send_json([h for h in HISTORY if h['time'].startswith(query.get('date', ''))])
+        elif path == '/api/entity_history' and (not self.options.no_entity_history):
+            day_from = query.get('from', '')
+            day_to = query.get('to', '9999')
+            rows = [h for h in HISTORY if h['entity_id'] == query.get('entity_id') and h['type'] == query.get('type', 'account') and day_from <= h['time'][:10] <= day_to]
+            offset = int(query.get('offset', 0) or 0)
+            limit = int(query.get('limit', 50) or 50)
+            page = rows[offset:offset + limit]
+            self._send_json({'items': page, 'next_offset': offset + limit if offset + limit < len(rows) else None})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if self.options.no_gzip_upload and self.headers.get('Content-Encoding'):
+            self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+            self._send_json({'error': 'unsupported encoding'}, 415)
+            return
+        try:
+            payload = self._read_json()
+        except ValueError:
+            self._send_json({'error': 'invalid json'}, 400)
+            return
+        if path in ('/api/submit_order', '/api/submit_payment'):
+            result = self._submit(path.rsplit('/', 1)[-1], payload)
+            self._send_json(result, 200 if result['status'] == 'success' else 400)
+        elif path == '/api/submit_batch' and (not self.options.no_batch):
+            results = []
+            for item in payload.get('items', []):
+                endpoint = item.get('endpoint')
+                if endpoint not in ('submit_order', 'submit_payment'):
+                    result = {'status': 'error', 'error': f'Unknown endpoint: {endpoint}'}
+                else:
+                    result = self._submit(endpoint, item.get('data') or {})
+                result['key'] = item.get('key')
+                results.append(result)
+            self._send_json({'results': results})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def log_message(self, fmt, *args):
+        if self.options.verbose:
+            super().log_message(fmt, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description='MagPro sync stub server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-batch', action='store_true', help='answer 404 on /api/submit_batch like an older server')
+    parser.add_argument('--reject-rate', type=float, default=0.0, help='fraction of items to reject')
+    parser.add_argument('--products', type=int, default=0, help='number of fake products served on /api/products')
+    parser.add_argument('--no-gzip-upload', action='store_true', help='answer 415 to gzip-encoded request bodies')
+    parser.add_argument('--history', type=int, default=0, help='number of fake history rows spread over today and yesterday')
+    parser.add_argument('--no-entity-history', action='store_true', help='answer 404 on /api/entity_history like an older server')
+    parser.add_argument('--verbose', action='store_true')
+    StubHandler.options = parser.parse_args()
+    for i in range(StubHandler.options.products):
+        PRODUCTS.append({'id': i + 1, 'name': f'Produit {i + 1}', 'barcode': str(6130000000000 + i), 'product_ref': f'REF{i + 1:05d}', 'price': 100.0 + i % 50, 'price_semi': 95.0, 'price_wholesale': 90.0, 'purchase_price': 70.0, 'stock': i % 30, 'stock_warehouse': 0, 'has_promo': i % 17 == 0})
+    days = [datetime.now().date(), datetime.now().date() - timedelta(days=1)]
+    for i in range(StubHandler.options.history):
+        entity_id = str(i % 7 + 1)
+        HISTORY.append({'id': i + 1, 'desc': f'BV-{i + 1}', 'amount': 100.0 + i % 30, 'time': f'{days[i % 2]} {i % 24:02d}:{i % 60:02d}', 'user': 'stub', 'entity': f'Client {entity_id}', 'entity_id': entity_id, 'type': 'account', 'is_transfer': False})
+    server = ThreadingHTTPServer((StubHandler.options.host, StubHandler.options.port), StubHandler)
+    print(f'Stub server listening on {StubHandler.options.host}:{StubHandler.options.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()